@@ -7,10 +7,29 @@ import sys
 import traceback
 import threading
 import time
+import importlib.util
+import itertools
+import atexit
+import collections
+import contextlib
+import functools
 import json
-import asyncio
+import mmap
+import operator
+import shutil
+import statistics
+import logging
+import logging.handlers
+import queue
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# orjson is optional; fall back to the standard library encoder without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from ..lib import fusionAddInUtils as futil
 
 # Dynamically resolve workspace paths to avoid hard-coded user-specific directories
@@ -41,28 +60,359 @@ def get_workspace_paths():
 app = adsk.core.Application.get()
 ui = app.userInterface
 server_thread = None
-server_running = False
-message_command_handlers = []  # Store command handlers to prevent garbage collection
+# Set while the server is stopped; cleared by start_server() and set again to stop it
+server_stop_event = threading.Event()
+server_stop_event.set()
+
+# Fallback message box commands still alive, as (command id, created handler)
+# pairs. Entries are dropped once their command has run; the cap only matters
+# for commands that never execute, whose definitions are deleted as they drop out.
+MAX_MESSAGE_COMMANDS = 16
+message_command_handlers = collections.deque(maxlen=MAX_MESSAGE_COMMANDS)
+# Ids of fallback commands that have finished. Their definitions can't be
+# deleted from inside their own execute event, so the next fallback cleans them up.
+finished_message_commands = []
+
+# Custom event used to show message boxes on Fusion's UI thread, registered in create_ui()
+MESSAGE_BOX_EVENT_ID = "MCPMessageBoxEvent"
+message_box_event = None
 
 # Initialize the global handlers list
 handlers = []
 
-# Function to check if MCP package is installed
+# Cached resource payloads (serialized JSON), keyed on the document (and
+# design revision where available) so repeated reads don't walk the Fusion
+# object model again.
+# Cleared by DocumentChangedHandler and by the tools that modify the design.
+_document_cache = {}
+_design_cache = {}
+
+# Parameter columns from collect_parameters, see get_parameter_columns().
+# The parameter resources are all built from these.
+_param_columns_cache = {}
+
+# Serialized results of the file-based read_resource command, as
+# uri -> (fingerprint, JSONBytes); see RESOURCE_FINGERPRINTS
+_response_cache = {}
+
+# Root component attributes for the standard planes accepted by create_new_sketch
+_STD_PLANES = {
+    "XY": "xYConstructionPlane",
+    "YZ": "yZConstructionPlane",
+    "XZ": "xZConstructionPlane"
+}
+
+# Named construction planes already looked up, keyed on (document, plane name)
+_plane_cache = {}
+
+# (doc, design, root_comp) for the active document, see get_active_design()
+_active_design_cache = {}
+
+# Number of file-based commands read ahead of the one being dispatched.
+# Reading commands and writing responses overlap; the Fusion calls
+# themselves run one at a time, in the order the files were queued.
+MONITOR_READ_AHEAD = 4
+
+# Held by whichever thread is calling into Fusion for a file command or an
+# MCP tool or resource (see with_fusion_lock in run_mcp_server). It is a
+# thread lock rather than an asyncio one so it also covers a call still
+# running in a thread after its monitor was cancelled, when another monitor
+# has taken over.
+fusion_dispatch_lock = threading.Lock()
+
+def call_with_fusion_lock(func, *args, **kwargs):
+    """Call func(*args, **kwargs) with fusion_dispatch_lock held."""
+    with fusion_dispatch_lock:
+        return func(*args, **kwargs)
+
+# Sequence used to give sketches created through MCP unique names
+_sketch_seq = itertools.count(1)
+
+# Parameter attributes reported by the fusion://parameters resource
+PARAMETER_FIELDS = ("name", "value", "expression", "unit", "comment")
+_get_parameter_fields = operator.attrgetter(*PARAMETER_FIELDS)
+
+def collect_parameters(design):
+    """Return the design's parameters as columns, one list per PARAMETER_FIELDS entry.
+
+    The lists are parallel: index i of every column describes the same parameter.
+    """
+    columns = tuple([] for _ in PARAMETER_FIELDS)
+    appends = tuple(column.append for column in columns)
+    get_fields = _get_parameter_fields
+    for param in design.allParameters:
+        for append, value in zip(appends, get_fields(param)):
+            append(value)
+    return dict(zip(PARAMETER_FIELDS, columns))
+
+def get_parameter_columns(doc, design):
+    """Return collect_parameters(design), reusing the last result while the
+    document, root component revision and parameter count are unchanged."""
+    key = (doc.name, design.rootComponent.revisionId, design.allParameters.count)
+    columns = _param_columns_cache.get(key)
+    if columns is None:
+        columns = collect_parameters(design)
+        _param_columns_cache.clear()
+        _param_columns_cache[key] = columns
+    return columns
+
+def _param_stats_kernel(values):
+    return values.min(), values.max(), values.mean(), values.std()
+
+def _param_stats_python(values):
+    mean = statistics.fmean(values)
+    return min(values), max(values), mean, statistics.pstdev(values, mean)
+
+# Parameter statistics implementation, picked on first use by get_param_stats_func()
+_param_stats_func = None
+
+def get_param_stats_func():
+    """Return a function computing (min, max, mean, std) of a list of values.
+    
+    Numba and NumPy are optional and only imported the first time statistics
+    are requested; with them the reduction is JIT-compiled (and cached on
+    disk), without them it is done in plain Python.
+    """
+    global _param_stats_func
+    if _param_stats_func is None:
+        try:
+            import numpy as np
+            from numba import njit
+        except ImportError:
+            _param_stats_func = _param_stats_python
+        else:
+            kernel = njit(cache=True)(_param_stats_kernel)
+            
+            def numba_param_stats(values):
+                return kernel(np.fromiter(values, dtype=np.float64, count=len(values)))
+            
+            _param_stats_func = numba_param_stats
+    return _param_stats_func
+
+def summarize_parameter_values(values):
+    """Return count, min, max, mean and (population) std of the parameter values."""
+    if not values:
+        return {"count": 0, "min": None, "max": None, "mean": None, "std": None}
+    low, high, mean, std = get_param_stats_func()(values)
+    return {"count": len(values), "min": float(low), "max": float(high), "mean": float(mean), "std": float(std)}
+
+def clear_resource_caches():
+    _document_cache.clear()
+    _design_cache.clear()
+    _param_columns_cache.clear()
+    _response_cache.clear()
+    _plane_cache.clear()
+    _active_design_cache.clear()
+
+class NoDesignError(Exception):
+    """Raised when the active document has no Fusion design to work with."""
+
+def get_active_design():
+    """Return (doc, design, root_comp) for the active document.
+    
+    The design and root component are remembered per document so repeated
+    calls skip the product lookup. Raises NoDesignError if there is no
+    active Fusion design.
+    """
+    doc = app.activeDocument
+    if not doc:
+        raise NoDesignError("No active document")
+    
+    cached = _active_design_cache.get(doc.name)
+    if cached is not None and cached[1].isValid:
+        return cached
+    
+    if doc.documentType != adsk.core.DocumentTypes.FusionDesignDocumentType:
+        raise NoDesignError("Not a Fusion design document")
+    
+    design = adsk.fusion.Design.cast(doc.products.itemByProductType('DesignProductType'))
+    if not design:
+        raise NoDesignError("No design in document")
+    
+    result = (doc, design, design.rootComponent)
+    _active_design_cache.clear()
+    _active_design_cache[doc.name] = result
+    return result
+
+def create_debug_logger(name, log_path):
+    """Create a logger whose records are written to log_path by a background
+    QueueListener, so callers never block on file I/O.
+
+    Returns the logger and the listener; stop the listener to flush and close
+    the file.
+    """
+    log_queue = queue.SimpleQueue()
+    file_handler = logging.FileHandler(log_path)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.handlers.clear()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logger, listener
+
+class BufferedDebugLog:
+    """Collect debug log lines per file and append them in batches.
+
+    A daemon thread sleeps until a line is buffered, then writes out whatever
+    has collected after `interval` seconds, or sooner once `max_pending` lines
+    are waiting, so logging from command handlers never opens a file on the
+    calling thread. close() stops the thread; lines appended after that,
+    e.g. by a server thread still shutting down, are written straight away.
+    """
+    
+    def __init__(self, interval=0.1, max_pending=64):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._buffers = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._has_lines = threading.Event()
+        self._full = threading.Event()
+        self._thread = None
+        self._stop = None
+        self._closed = False
+    
+    def append(self, path, text):
+        with self._lock:
+            if self._closed:
+                self._write(path, (text,))
+                return
+            
+            buffer = self._buffers.get(path)
+            if buffer is None:
+                buffer = self._buffers[path] = collections.deque()
+            buffer.append(text)
+            self._pending += 1
+            
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), name="MCPDebugLog", daemon=True)
+                self._thread.start()
+            if self._pending == 1:
+                self._has_lines.set()
+            if self._pending >= self.max_pending:
+                self._full.set()
+    
+    def flush(self):
+        """Write all buffered lines, one open and writelines per file."""
+        with self._flush_lock:
+            with self._lock:
+                batches, self._buffers = self._buffers, {}
+                self._pending = 0
+                self._has_lines.clear()
+                self._full.clear()
+            
+            for path, batch in batches.items():
+                self._write(path, batch)
+    
+    def _write(self, path, lines):
+        try:
+            with open(path, "a") as f:
+                f.writelines(lines)
+        except OSError as e:
+            print(f"Error writing debug log {path}: {str(e)}")
+    
+    def close(self, timeout=2.0):
+        """Stop the writer thread and write out anything still buffered."""
+        with self._lock:
+            self._closed = True
+            thread, self._thread = self._thread, None
+            stop = self._stop
+        
+        if thread is not None:
+            stop.set()
+            self._has_lines.set()
+            self._full.set()
+            thread.join(timeout=timeout)
+        self.flush()
+    
+    def _run(self, stop):
+        while not stop.is_set():
+            # Nothing is buffered: sleep until append() has something
+            self._has_lines.wait()
+            if not stop.is_set():
+                # Let more lines collect unless the batch is already full
+                self._full.wait(self.interval)
+            self.flush()
+
+# Shared by everything in this module that writes debug files. stop()
+# closes it and drops the atexit hook, so reloading the add-in doesn't
+# leave a thread and a hook behind per load.
+debug_log = BufferedDebugLog()
+atexit.register(debug_log.close)
+
+def to_json(data, indent=False):
+    """Serialize data to a JSON string, using orjson when it is available."""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0).decode("utf-8")
+    return json.dumps(data, indent=2 if indent else None)
+
+# Command files larger than this are memory-mapped instead of read
+MMAP_THRESHOLD = 64 * 1024
+
+def read_json_file(path):
+    """Parse a JSON file, parsing the raw bytes with orjson when it is available."""
+    if orjson is None:
+        with open(path, "r") as f:
+            return json.load(f)
+    
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                return orjson.loads(view)
+        return orjson.loads(f.read())
+
+class JSONBytes(bytes):
+    """A value that has already been serialized to JSON."""
+
+def to_json_bytes(data):
+    """Serialize data to compact JSON bytes, using orjson when it is available."""
+    if isinstance(data, JSONBytes):
+        return data
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode("utf-8")
+
+def write_json_file(path, data):
+    """Write data as compact JSON to path; JSONBytes are written as they are.
+    
+    The bytes go to a temporary file that is then moved over path, so a
+    client polling for the file never sees a partial response.
+    """
+    payload = to_json_bytes(data)
+    
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        with memoryview(payload) as view:
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+# Function to check if MCP package is installed. Only the import specs are
+# looked up, so the packages aren't loaded until the server actually starts.
 def check_mcp_installed():
     missing_packages = []
     
-    try:
-        import mcp
-        print(f"Found MCP package at: {mcp.__file__}")
-    except ImportError as e:
-        print(f"Error importing MCP package: {str(e)}")
+    mcp_spec = importlib.util.find_spec("mcp")
+    if mcp_spec:
+        print(f"Found MCP package at: {mcp_spec.origin}")
+    else:
+        print("Error finding MCP package: No module named 'mcp'")
         missing_packages.append("mcp[cli]")
     
-    try:
-        import uvicorn
-        print(f"Found uvicorn package at: {uvicorn.__file__}")
-    except ImportError as e:
-        print(f"Error importing uvicorn package: {str(e)}")
+    uvicorn_spec = importlib.util.find_spec("uvicorn")
+    if uvicorn_spec:
+        print(f"Found uvicorn package at: {uvicorn_spec.origin}")
+    else:
+        print("Error finding uvicorn package: No module named 'uvicorn'")
         missing_packages.append("uvicorn")
     
     if missing_packages:
@@ -71,15 +421,311 @@ def check_mcp_installed():
     
     return True
 
+# Server dependencies, imported on first use by load_server_modules()
+_server_modules = None
+
+def load_server_modules():
+    """Import mcp, FastMCP and uvicorn the first time the server starts.
+    
+    These pull in a large dependency tree, so they are kept out of add-in
+    load and only imported once the server is actually enabled.
+    """
+    global _server_modules
+    if _server_modules is None:
+        import mcp
+        from mcp.server.fastmcp import FastMCP
+        import uvicorn
+        _server_modules = (mcp, FastMCP, uvicorn)
+    return _server_modules
+
+def create_new_sketch(plane_name: str) -> str:
+    """Create a new sketch on the specified plane."""
+    try:
+        doc, design, root_comp = get_active_design()
+        
+        # Find the plane
+        # Check if the plane_name is a standard plane (XY, YZ, XZ)
+        plane_attr = _STD_PLANES.get(plane_name.upper())
+        if plane_attr:
+            sketch_plane = getattr(root_comp, plane_attr)
+        else:
+            # Try to find a construction plane with the given name
+            cache_key = (doc.name, plane_name)
+            sketch_plane = _plane_cache.get(cache_key)
+            if sketch_plane is None or not sketch_plane.isValid:
+                sketch_plane = root_comp.constructionPlanes.itemByName(plane_name)
+                if sketch_plane:
+                    _plane_cache[cache_key] = sketch_plane
+        
+        if not sketch_plane:
+            return f"Could not find plane: {plane_name}"
+        
+        # Create the sketch
+        sketches = root_comp.sketches
+        sketch = sketches.add(sketch_plane)
+        _design_cache.clear()
+        _response_cache.clear()
+        sketch.name = f"Sketch_MCP_{next(_sketch_seq)}"
+        
+        return f"Sketch created successfully: {sketch.name}"
+    except NoDesignError as e:
+        return str(e)
+    except Exception as e:
+        error_msg = f"Error creating sketch: {str(e)}"
+        print(error_msg)
+        print(traceback.format_exc())
+        return error_msg
+
+def create_parameter(name: str, expression: str, unit: str, comment: str = "") -> str:
+    """Create a new parameter in the active design."""
+    try:
+        _, design, _ = get_active_design()
+        
+        # Create the parameter
+        try:
+            param = design.userParameters.add(name, adsk.core.ValueInput.createByString(expression), unit, comment)
+            _param_columns_cache.clear()
+            _response_cache.clear()
+            return f"Parameter created successfully: {param.name} = {param.expression}"
+        except Exception as e:
+            # Check if parameter already exists
+            existing_param = design.userParameters.itemByName(name)
+            if existing_param:
+                # Update the existing parameter
+                existing_param.expression = expression
+                existing_param.unit = unit
+                if comment:
+                    existing_param.comment = comment
+                _param_columns_cache.clear()
+                _response_cache.clear()
+                return f"Parameter updated: {existing_param.name} = {existing_param.expression}"
+            else:
+                raise e
+    except NoDesignError as e:
+        return str(e)
+    except Exception as e:
+        error_msg = f"Error creating parameter: {str(e)}"
+        print(error_msg)
+        print(traceback.format_exc())
+        return error_msg
+
+# Handlers for the file-based commands, looked up by name in COMMAND_HANDLERS.
+# Each takes the command's params, the Fusion application and the workspace
+# communication directory and returns the result to write to the response file.
+def _handle_list_resources(params, app, workspace_comm_dir):
+    return LIST_RESOURCES_RESULT
+
+def _handle_list_tools(params, app, workspace_comm_dir):
+    return LIST_TOOLS_RESULT
+
+def _handle_list_prompts(params, app, workspace_comm_dir):
+    return LIST_PROMPTS_RESULT
+
+def _handle_message_box(params, app, workspace_comm_dir):
+    message = params.get("message", "")
+    
+    # Create debug log
+    debug_file = os.path.join(workspace_comm_dir, "command_message_debug.txt")
+    debug_log.append(debug_file, f"Processing message_box command with: {message} at {time.ctime()}\n")
+    
+    # Use command-based approach for message display
+    try:
+        create_message_box_command(message)
+        debug_log.append(debug_file, f"Command-based display triggered at {time.ctime()}\n")
+    except Exception as e:
+        debug_log.append(debug_file, f"Command-based display attempt failed: {str(e)}\n")
+    
+    return "Message processed successfully"
+
+def _handle_create_new_sketch(params, app, workspace_comm_dir):
+    return create_new_sketch(params.get("plane_name", "XY"))
+
+def _handle_create_parameter(params, app, workspace_comm_dir):
+    return create_parameter(
+        params.get("name", f"Param_{int(time.time()) % 10000}"),
+        params.get("expression", "10"),
+        params.get("unit", "mm"),
+        params.get("comment", "")
+    )
+
+def _handle_read_resource(params, app, workspace_comm_dir):
+    uri = params.get("uri", "")
+    reader = RESOURCE_HANDLERS.get(uri)
+    if reader is None:
+        return {"error": f"Unknown resource URI: {uri}"}
+    try:
+        # Reuse the serialized result while the resource's fingerprint is unchanged
+        fingerprint_func = RESOURCE_FINGERPRINTS.get(uri)
+        fingerprint = fingerprint_func(app) if fingerprint_func else None
+        if fingerprint is None:
+            return reader(app)
+        
+        cached = _response_cache.get(uri)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        
+        result = JSONBytes(to_json_bytes(reader(app)))
+        _response_cache[uri] = (fingerprint, result)
+        return result
+    except Exception as e:
+        return {"error": str(e)}
+
+def _handle_get_prompt(params, app, workspace_comm_dir):
+    prompt_name = params.get("name", "")
+    builder = PROMPT_HANDLERS.get(prompt_name)
+    if builder is None:
+        return {"error": f"Unknown prompt: {prompt_name}"}
+    return builder(params.get("args", {}))
+
+# Resource readers for the file-based read_resource command
+def _read_active_document_info(app):
+    doc = app.activeDocument
+    if not doc:
+        return {"error": "No active document"}
+    return {
+        "name": doc.name,
+        "path": doc.dataFile.name if doc.dataFile else "Unsaved",
+        "type": "FusionDesignDocumentType" if doc.products.itemByProductType('DesignProductType') else "Unknown"
+    }
+
+def _read_design_structure(app):
+    _, fusion_design, root_comp = get_active_design()
+    
+    # Simplified response with just basic info
+    return {
+        "design_name": fusion_design.name,
+        "root_component": {
+            "name": root_comp.name,
+            "bodies_count": root_comp.bodies.count,
+            "sketches_count": root_comp.sketches.count,
+            "occurrences_count": root_comp.occurrences.count
+        }
+    }
+
+def _read_parameters(app):
+    doc, fusion_design, _ = get_active_design()
+    return {"parameters": get_parameter_columns(doc, fusion_design)}
+
+def _read_parameter_stats(app):
+    doc, fusion_design, _ = get_active_design()
+    return {"stats": summarize_parameter_values(get_parameter_columns(doc, fusion_design)["value"])}
+
+# Cheap fingerprints of what each resource reader returns, used to decide
+# whether a cached result is still current. None means don't cache.
+def _fingerprint_active_document(app):
+    doc = app.activeDocument
+    return (doc.name,) if doc else None
+
+def _fingerprint_design_structure(app):
+    doc, _, root_comp = get_active_design()
+    return (doc.name, root_comp.revisionId, root_comp.bodies.count, root_comp.sketches.count, root_comp.occurrences.count)
+
+def _fingerprint_parameters(app):
+    doc, design, root_comp = get_active_design()
+    return (doc.name, root_comp.revisionId, design.allParameters.count)
+
+# Prompt builders for the file-based get_prompt command. The system messages
+# never change, so they are built once and shared by every response.
+_CREATE_SKETCH_SYSTEM = {
+    "role": "system",
+    "content": "You are an expert in Fusion 360 CAD modeling. Your task is to help the user create sketches based on their descriptions.\n\nBe very specific about what planes to use and what sketch entities to create."
+}
+
+_PARAMETER_SETUP_SYSTEM = {
+    "role": "system",
+    "content": "You are an expert in Fusion 360 parametric design. Your task is to help the user set up parameters for their design.\n\nSuggest appropriate parameters, their values, units, and purposes based on the user's description."
+}
+
+def _build_create_sketch_prompt(description):
+    return {
+        "messages": [
+            _CREATE_SKETCH_SYSTEM,
+            {
+                "role": "user",
+                "content": f"I want to create a sketch with these requirements: {description}\n\nPlease provide step-by-step instructions for creating this sketch in Fusion 360."
+            }
+        ]
+    }
+
+def _build_parameter_setup_prompt(description):
+    return {
+        "messages": [
+            _PARAMETER_SETUP_SYSTEM,
+            {
+                "role": "user",
+                "content": f"I want to set up parameters for: {description}\n\nWhat parameters should I create, and what values, units, and comments should they have?"
+            }
+        ]
+    }
+
+def _get_create_sketch_prompt(prompt_args):
+    return _build_create_sketch_prompt(prompt_args.get("description", "Default sketch"))
+
+def _get_parameter_setup_prompt(prompt_args):
+    return _build_parameter_setup_prompt(prompt_args.get("description", "Default parameters"))
+
+COMMAND_HANDLERS = {
+    "list_resources": _handle_list_resources,
+    "list_tools": _handle_list_tools,
+    "list_prompts": _handle_list_prompts,
+    "message_box": _handle_message_box,
+    "create_new_sketch": _handle_create_new_sketch,
+    "create_parameter": _handle_create_parameter,
+    "read_resource": _handle_read_resource,
+    "get_prompt": _handle_get_prompt
+}
+
+RESOURCE_HANDLERS = {
+    "fusion://active-document-info": _read_active_document_info,
+    "fusion://design-structure": _read_design_structure,
+    "fusion://parameters": _read_parameters,
+    "fusion://parameters/stats": _read_parameter_stats
+}
+
+RESOURCE_FINGERPRINTS = {
+    "fusion://active-document-info": _fingerprint_active_document,
+    "fusion://design-structure": _fingerprint_design_structure,
+    "fusion://parameters": _fingerprint_parameters,
+    "fusion://parameters/stats": _fingerprint_parameters
+}
+
+PROMPT_HANDLERS = {
+    "create_sketch_prompt": _get_create_sketch_prompt,
+    "parameter_setup_prompt": _get_parameter_setup_prompt
+}
+
+# Static results of the list_* commands
+LIST_RESOURCES_RESULT = tuple(RESOURCE_HANDLERS)
+
+LIST_TOOLS_RESULT = (
+    {"name": "message_box", "description": "Display a message box in Fusion 360"},
+    {"name": "create_new_sketch", "description": "Create a new sketch on the specified plane"},
+    {"name": "create_parameter", "description": "Create a new parameter in the active design"}
+)
+
+LIST_PROMPTS_RESULT = (
+    {"name": "create_sketch_prompt", "description": "Create a prompt for creating a sketch based on a description"},
+    {"name": "parameter_setup_prompt", "description": "Create a prompt for setting up parameters based on a description"}
+)
+
 # Function to run MCP server
 def run_mcp_server():
     try:
         # Import required MCP modules
-        import mcp
-        from mcp.server.fastmcp import FastMCP
-        import uvicorn
+        mcp, FastMCP, uvicorn = load_server_modules()
+        import asyncio
         import threading
-        
+
+        # watchfiles ships with uvicorn[standard]; without it the file
+        # monitor falls back to polling the communication directories
+        try:
+            from watchfiles import awatch, Change
+            # Its per-batch "N changes detected" messages would end up in
+            # Fusion's console
+            logging.getLogger("watchfiles").setLevel(logging.WARNING)
+        except ImportError:
+            awatch = None
+
         # Resolve workspace paths
         workspace_path, workspace_comm_dir = get_workspace_paths()
         
@@ -89,17 +735,14 @@ def run_mcp_server():
                 test_message = "MCP Server startup test message"
                 debug_path = os.path.join(workspace_comm_dir, "startup_test_message.txt")
                 
-                with open(debug_path, "a") as f:
-                    f.write(f"Trying command-based test message at server startup: {time.ctime()}\n")
+                debug_log.append(debug_path, f"Trying command-based test message at server startup: {time.ctime()}\n")
                 
                 # Try to show the message box using command-based approach
                 create_message_box_command(test_message)
                 
-                with open(debug_path, "a") as f:
-                    f.write(f"Command-based test message triggered at {time.ctime()}\n")
+                debug_log.append(debug_path, f"Command-based test message triggered at {time.ctime()}\n")
             except Exception as e:
-                with open(debug_path, "a") as f:
-                    f.write(f"Command-based test message failed: {str(e)} at {time.ctime()}\n")
+                debug_log.append(debug_path, f"Command-based test message failed: {str(e)} at {time.ctime()}\n")
         
         # Schedule the test message using threading.Timer
         test_timer = threading.Timer(3.0, test_direct_message)
@@ -108,47 +751,73 @@ def run_mcp_server():
         
         # Create diagnostic log in the workspace communication directory
         
-        # Write diagnostic info without relying on __version__
+        # The startup files below don't depend on each other, so they are
+        # written from a small thread pool while the server is being set up.
+        # Their futures are checked before uvicorn starts so a failed write
+        # still aborts startup as before.
+        startup_executor = ThreadPoolExecutor(max_workers=4)
+        startup_tasks = []
+        
+        # Collect diagnostic info without relying on __version__; the whole
+        # log is written in one go once the FastMCP object exists
         diagnostic_log = os.path.join(workspace_comm_dir, "mcp_server_diagnostics.log")
-        with open(diagnostic_log, "w") as f:
-            f.write(f"MCP Server Diagnostics - {time.ctime()}\n\n")
-            f.write(f"Server URL: http://127.0.0.1:3000/sse\n")
-            f.write(f"Workspace directory: {workspace_path}\n")
-            f.write(f"Communication directory: {workspace_comm_dir}\n\n")
-            f.write(f"Python version: {sys.version}\n\n")
-            
-            # Get MCP version safely if available
-            try:
-                mcp_version = getattr(mcp, "__version__", "Unknown")
-                f.write(f"MCP Version: {mcp_version}\n\n")
-            except:
-                f.write("MCP Version: Unable to determine\n\n")
-            
-            f.write(f"Registered Resources:\n  (Method available_resources() not available in this MCP SDK version)\n\n")
-            f.write(f"Registered Tools:\n  (Method available_tools() not available in this MCP SDK version)\n\n")
-            f.write(f"Registered Prompts:\n  (Method available_prompts() not available in this MCP SDK version)\n\n")
-            f.write(f"Environment:\n  Python version: {sys.version}\n  MCP SDK available: True\n\n")
+        diagnostics = [
+            f"MCP Server Diagnostics - {time.ctime()}\n\n",
+            f"Server URL: http://127.0.0.1:3000/sse\n",
+            f"Workspace directory: {workspace_path}\n",
+            f"Communication directory: {workspace_comm_dir}\n\n",
+            f"Python version: {sys.version}\n\n"
+        ]
+        
+        # Get MCP version safely if available
+        try:
+            mcp_version = getattr(mcp, "__version__", "Unknown")
+            diagnostics.append(f"MCP Version: {mcp_version}\n\n")
+        except:
+            diagnostics.append("MCP Version: Unable to determine\n\n")
+        
+        diagnostics.append(f"Registered Resources:\n  (Method available_resources() not available in this MCP SDK version)\n\n")
+        diagnostics.append(f"Registered Tools:\n  (Method available_tools() not available in this MCP SDK version)\n\n")
+        diagnostics.append(f"Registered Prompts:\n  (Method available_prompts() not available in this MCP SDK version)\n\n")
+        diagnostics.append(f"Environment:\n  Python version: {sys.version}\n  MCP SDK available: True\n\n")
         
         print("Creating FastMCP server instance...")
         # Create the MCP server
         fusion_mcp = FastMCP("Fusion 360 MCP Server")
         
-        # Write more diagnostics about the FastMCP object
-        with open(diagnostic_log, "a") as f:
-            f.write(f"FastMCP Object Attributes:\n")
-            for attr in dir(fusion_mcp):
-                if not attr.startswith('_'):
-                    f.write(f"  - {attr}\n")
-            f.write("\n")
+        # Add diagnostics about the FastMCP object
+        public_attrs = [attr for attr in dir(fusion_mcp) if not attr.startswith('_')]
+        diagnostics.append("FastMCP Object Attributes:\n")
+        if public_attrs:
+            diagnostics.append("  - " + "\n  - ".join(public_attrs) + "\n")
+        diagnostics.append("\n")
+        
+        startup_tasks.append(startup_executor.submit(
+            Path(diagnostic_log).write_bytes, "".join(diagnostics).encode("utf-8")
+        ))
+        
+        def with_fusion_lock(func):
+            """Wrap a tool or resource so FastMCP runs it in a worker thread
+            holding fusion_dispatch_lock, like the file-based commands, rather
+            than on the uvicorn loop alongside them."""
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                return await asyncio.to_thread(call_with_fusion_lock, func, *args, **kwargs)
+            return wrapper
         
         print("Registering resources...")
         # Define resources - Note: All resource URIs must have a scheme
-        @fusion_mcp.resource("fusion://active-document-info")
+        @fusion_mcp.resource("fusion://active-document-info", mime_type="application/json")
+        @with_fusion_lock
         def get_active_document_info():
             """Get information about the active document in Fusion 360."""
             try:
                 doc = app.activeDocument
                 if doc:
+                    cached = _document_cache.get(doc.name)
+                    if cached is not None:
+                        return cached
+                    
                     path = "Unsaved"
                     try:
                         if hasattr(doc, 'dataFile') and doc.dataFile:
@@ -156,32 +825,29 @@ def run_mcp_server():
                     except:
                         pass
                         
-                    return {
+                    info = to_json({
                         "name": doc.name,
                         "path": path,
                         "type": str(doc.documentType)
-                    }
+                    })
+                    _document_cache[doc.name] = info
+                    return info
                 else:
                     return {"error": "No active document"}
             except Exception as e:
                 return {"error": str(e) + "\n" + traceback.format_exc()}
         
-        @fusion_mcp.resource("fusion://design-structure")
+        @fusion_mcp.resource("fusion://design-structure", mime_type="application/json")
+        @with_fusion_lock
         def get_design_structure():
             """Get the structure of the active design in Fusion 360."""
             try:
-                doc = app.activeDocument
-                if not doc:
-                    return {"error": "No active document"}
+                doc, design, root_comp = get_active_design()
                 
-                if str(doc.documentType) != "FusionDesignDocumentType":
-                    return {"error": "Not a Fusion design document"}
-                
-                design = adsk.fusion.Design.cast(doc.products.itemByProductType('DesignProductType'))
-                if not design:
-                    return {"error": "No design in document"}
-                
-                root_comp = design.rootComponent
+                cache_key = (doc.name, root_comp.revisionId)
+                cached = _design_cache.get(cache_key)
+                if cached is not None:
+                    return cached
                 
                 def get_component_data(component):
                     data = {
@@ -199,157 +865,83 @@ def run_mcp_server():
                     
                     return data
                 
-                return {
+                structure = to_json({
                     "design_name": design.name,
                     "root_component": get_component_data(root_comp)
-                }
+                })
+                _design_cache[cache_key] = structure
+                return structure
+            except NoDesignError as e:
+                return {"error": str(e)}
             except Exception as e:
                 return {"error": str(e) + "\n" + traceback.format_exc()}
         
-        @fusion_mcp.resource("fusion://parameters")
+        @fusion_mcp.resource("fusion://parameters", mime_type="application/json")
+        @with_fusion_lock
         def get_parameters():
-            """Get the parameters of the active design in Fusion 360."""
+            """Get the parameters of the active design in Fusion 360.
+            
+            Parameters are returned column-wise as {"parameters": {"name": [...],
+            "value": [...], "expression": [...], "unit": [...], "comment": [...]}},
+            where the same index in each list belongs to the same parameter.
+            """
             try:
-                doc = app.activeDocument
-                if not doc:
-                    return {"error": "No active document"}
-                
-                if str(doc.documentType) != "FusionDesignDocumentType":
-                    return {"error": "Not a Fusion design document"}
-                
-                design = adsk.fusion.Design.cast(doc.products.itemByProductType('DesignProductType'))
-                if not design:
-                    return {"error": "No design in document"}
-                
-                params = []
-                for param in design.allParameters:
-                    params.append({
-                        "name": param.name,
-                        "value": param.value,
-                        "expression": param.expression,
-                        "unit": param.unit,
-                        "comment": param.comment
-                    })
-                
-                return {"parameters": params}
+                doc, design, _ = get_active_design()
+                return to_json({"parameters": get_parameter_columns(doc, design)})
+            except NoDesignError as e:
+                return {"error": str(e)}
+            except Exception as e:
+                return {"error": str(e) + "\n" + traceback.format_exc()}
+        
+        @fusion_mcp.resource("fusion://parameters/stats", mime_type="application/json")
+        @with_fusion_lock
+        def get_parameter_stats():
+            """Get count, min, max, mean and std of the parameter values of the active design."""
+            try:
+                doc, design, _ = get_active_design()
+                values = get_parameter_columns(doc, design)["value"]
+                return to_json({"stats": summarize_parameter_values(values)})
+            except NoDesignError as e:
+                return {"error": str(e)}
             except Exception as e:
                 return {"error": str(e) + "\n" + traceback.format_exc()}
         
         print("Registering tools...")
+        # Debug logging for the message_box tool is only enabled when the
+        # FUSION_MCP_DEBUG environment variable is set
+        message_tool_log = None
+        message_tool_listener = None
+        if os.getenv("FUSION_MCP_DEBUG"):
+            message_tool_log, message_tool_listener = create_debug_logger(
+                "fusion_mcp.message_tool",
+                os.path.join(workspace_comm_dir, "message_tool_debug.txt")
+            )
+        
         # Define tools
         @fusion_mcp.tool()
+        @with_fusion_lock
         def message_box(message: str) -> str:
             """Display a message box in Fusion 360."""
             try:
                 # Log the attempt
-                debug_path = "C:/Users/Joseph/Documents/code/fusion-mcp-server/mcp_comm/message_tool_debug.txt"
-                with open(debug_path, "a") as f:
-                    f.write(f"Message box tool called with: {message} at {time.ctime()}\n")
+                if message_tool_log:
+                    message_tool_log.debug("Message box tool called with: %s", message)
                 
                 # Try to show directly
                 success = show_message_box(message)
                 
                 # Log result
-                with open(debug_path, "a") as f:
-                    f.write(f"Direct show result: {success} at {time.ctime()}\n")
+                if message_tool_log:
+                    message_tool_log.debug("Direct show result: %s", success)
                 
                 return "Message displayed successfully (queued if not shown immediately)"
             except Exception as e:
                 return f"Error displaying message: {str(e)}"
         
-        @fusion_mcp.tool()
-        def create_new_sketch(plane_name: str) -> str:
-            """Create a new sketch on the specified plane."""
-            try:
-                doc = app.activeDocument
-                if not doc:
-                    return "No active document"
-                
-                # Check for design product
-                design_product = doc.products.itemByProductType('DesignProductType')
-                if not design_product:
-                    return "Active document is not a design document"
-                
-                # Cast to Design type
-                design = adsk.fusion.Design.cast(design_product)
-                if not design:
-                    return "Failed to get design from document"
-                
-                root_comp = design.rootComponent
-                
-                # Find the plane
-                sketch_plane = None
-                
-                # Check if the plane_name is a standard plane (XY, YZ, XZ)
-                if plane_name.upper() == "XY":
-                    sketch_plane = root_comp.xYConstructionPlane
-                elif plane_name.upper() == "YZ":
-                    sketch_plane = root_comp.yZConstructionPlane
-                elif plane_name.upper() == "XZ":
-                    sketch_plane = root_comp.xZConstructionPlane
-                else:
-                    # Try to find a construction plane with the given name
-                    construction_planes = root_comp.constructionPlanes
-                    for i in range(construction_planes.count):
-                        plane = construction_planes.item(i)
-                        if plane.name == plane_name:
-                            sketch_plane = plane
-                            break
-                
-                if not sketch_plane:
-                    return f"Could not find plane: {plane_name}"
-                
-                # Create the sketch
-                sketches = root_comp.sketches
-                sketch = sketches.add(sketch_plane)
-                sketch.name = f"Sketch_MCP_{int(time.time()) % 10000}"
-                
-                return f"Sketch created successfully: {sketch.name}"
-            except Exception as e:
-                error_msg = f"Error creating sketch: {str(e)}"
-                print(error_msg)
-                print(traceback.format_exc())
-                return error_msg
-        
-        @fusion_mcp.tool()
-        def create_parameter(name: str, expression: str, unit: str, comment: str = "") -> str:
-            """Create a new parameter in the active design."""
-            try:
-                doc = app.activeDocument
-                if not doc:
-                    return "No active document"
-                
-                # Check for design product
-                design_product = doc.products.itemByProductType('DesignProductType')
-                if not design_product:
-                    return "Active document is not a design document"
-                
-                # Cast to Design type
-                design = adsk.fusion.Design.cast(design_product)
-                if not design:
-                    return "Failed to get design from document"
-                
-                # Create the parameter
-                try:
-                    param = design.userParameters.add(name, adsk.core.ValueInput.createByString(expression), unit, comment)
-                    return f"Parameter created successfully: {param.name} = {param.expression}"
-                except Exception as e:
-                    # Check if parameter already exists
-                    existing_param = design.userParameters.itemByName(name)
-                    if existing_param:
-                        # Update the existing parameter
-                        existing_param.expression = expression
-                        existing_param.unit = unit
-                        if comment:
-                            existing_param.comment = comment
-                        return f"Parameter updated: {existing_param.name} = {existing_param.expression}"
-                    else:
-                        raise e
-            except Exception as e:
-                error_msg = f"Error creating parameter: {str(e)}"
-                print(error_msg)
-                print(traceback.format_exc())
-                return error_msg
+        # These are defined at module level so the file-based commands can
+        # use them too
+        fusion_mcp.tool()(with_fusion_lock(create_new_sketch))
+        fusion_mcp.tool()(with_fusion_lock(create_parameter))
         
         print("Registering prompts...")
         # Define prompts
@@ -403,64 +995,90 @@ Suggest appropriate parameters, their values, units, and purposes based on the u
         if os.path.exists(workspace_path):
             os.makedirs(str(workspace_comm_dir), exist_ok=True)
         
-        # Create a list of communication directories to monitor
-        comm_dirs = [
+        # The communication directories to monitor; fixed for the server's lifetime
+        comm_dirs = (
             addon_comm_dir,
             str(workspace_comm_dir)
-        ]
+        )
         
         # Create desktop path for ready file
         ready_file_desktop = os.path.expanduser("~/Desktop/mcp_server_ready.txt")
         
         # Create server info file
-        server_info_file = os.path.join(workspace_comm_dir, "mcp_server_info.txt")
-        with open(server_info_file, "w") as f:
-            f.write(f"MCP Server started at {time.ctime()}\n")
-            f.write(f"Python version: {sys.version}\n")
+        def write_server_info():
+            server_info_file = os.path.join(workspace_comm_dir, "mcp_server_info.txt")
+            with open(server_info_file, "w") as f:
+                f.write(f"MCP Server started at {time.ctime()}\n")
+                f.write(f"Python version: {sys.version}\n")
+        
+        startup_tasks.append(startup_executor.submit(write_server_info))
         
         # Create server status file with JSON structure
-        server_status_file = os.path.join(workspace_comm_dir, "server_status.json")
-        with open(server_status_file, "w") as f:
-            status_data = {
-                "status": "running",
-                "started_at": time.ctime(),
-                "server_url": "http://127.0.0.1:3000/sse",
-                "fusion_version": app.version,
-                "available_resources": [
-                    "fusion://active-document-info",
-                    "fusion://design-structure",
-                    "fusion://parameters"
-                ],
-                "available_tools": [
-                    "message_box",
-                    "create_new_sketch",
-                    "create_parameter"
-                ],
-                "available_prompts": [
-                    "create_sketch_prompt",
-                    "parameter_setup_prompt"
-                ]
-            }
-            json.dump(status_data, f, indent=2)
+        status_data = {
+            "status": "running",
+            "started_at": time.ctime(),
+            "server_url": "http://127.0.0.1:3000/sse",
+            "fusion_version": app.version,
+            "available_resources": [
+                "fusion://active-document-info",
+                "fusion://design-structure",
+                "fusion://parameters",
+                "fusion://parameters/stats"
+            ],
+            "available_tools": [
+                "message_box",
+                "create_new_sketch",
+                "create_parameter"
+            ],
+            "available_prompts": [
+                "create_sketch_prompt",
+                "parameter_setup_prompt"
+            ]
+        }
         
-        # Create all ready file paths
-        ready_files = [
+        def write_server_status():
+            server_status_file = os.path.join(workspace_comm_dir, "server_status.json")
+            with open(server_status_file, "w") as f:
+                f.write(to_json(status_data, indent=True))
+        
+        startup_tasks.append(startup_executor.submit(write_server_status))
+        
+        # Create all ready file paths (some of them can resolve to the same file)
+        ready_files = list(dict.fromkeys([
             ready_file_desktop,
             os.path.join(os.path.dirname(os.path.dirname(__file__)), "mcp_server_ready.txt"),
             os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "mcp_server_ready.txt"),
             os.path.join(workspace_path, "mcp_server_ready.txt"),
-            str(workspace_comm_dir / "mcp_server_ready.txt")
-        ]
+            os.path.join(workspace_comm_dir, "mcp_server_ready.txt")
+        ]))
         
-        # Create all ready files
-        for ready_file in ready_files:
+        # Write the first ready file once, then copy it to the other
+        # locations concurrently
+        ready_content = f"MCP Server Ready - {time.ctime()}".encode("utf-8")
+        
+        def create_ready_file(ready_file, source=None):
             try:
                 os.makedirs(os.path.dirname(ready_file), exist_ok=True)
-                with open(ready_file, "w") as f:
-                    f.write(f"MCP Server Ready - {time.ctime()}")
+                if source:
+                    shutil.copyfile(source, ready_file)
+                else:
+                    Path(ready_file).write_bytes(ready_content)
                 print(f"Created ready file: {ready_file}")
+                return True
             except Exception as e:
                 print(f"Error creating ready file at {ready_file}: {str(e)}")
+                return False
+        
+        # The first write is queued ahead of the copies, so it is always
+        # picked up by a worker before any copy starts waiting on it
+        first_ready_file = startup_executor.submit(create_ready_file, ready_files[0])
+        
+        def copy_ready_file(ready_file):
+            source = ready_files[0] if first_ready_file.result() else None
+            create_ready_file(ready_file, source)
+        
+        for ready_file in ready_files[1:]:
+            startup_executor.submit(copy_ready_file, ready_file)
         
         # Run the FastMCP server
         print("Starting MCP server using FastMCP with uvicorn")
@@ -472,12 +1090,35 @@ Suggest appropriate parameters, their values, units, and purposes based on the u
         host = "127.0.0.1"
         port = 3000  # Default port for SSE
         
-        # Create a Config instance for uvicorn
+        # Prefer the uvloop event loop and httptools parser when they are
+        # installed (uvicorn[standard]); uvloop is not available on Windows
+        try:
+            import uvloop
+            loop_impl = "uvloop"
+        except ImportError:
+            loop_impl = "asyncio"
+
+        try:
+            import httptools
+            http_impl = "httptools"
+        except ImportError:
+            http_impl = "h11"
+
+        print(f"Using {loop_impl} event loop and {http_impl} HTTP parser")
+
+        # Create a Config instance for uvicorn. Access logging and the
+        # server/date headers are disabled so SSE events don't pay for
+        # per-request log formatting and header construction.
         config = uvicorn.Config(
             sse_app,
             host=host,
             port=port,
-            log_level="info"
+            log_level="warning",
+            access_log=False,
+            server_header=False,
+            date_header=False,
+            loop=loop_impl,
+            http=http_impl
         )
         
         # Create server instance
@@ -494,8 +1135,13 @@ Suggest appropriate parameters, their values, units, and purposes based on the u
                 
                 # Run the server
                 server.run()
-            except Exception as e:
-                error_msg = f"Error in uvicorn server: {str(e)}"
+            except (Exception, SystemExit) as e:
+                # uvicorn calls sys.exit(1) when startup fails, e.g. when the
+                # port is already in use
+                if isinstance(e, SystemExit):
+                    error_msg = f"uvicorn server exited during startup (status {e.code})"
+                else:
+                    error_msg = f"Error in uvicorn server: {str(e)}"
                 print(error_msg)
                 
                 # Write error to file
@@ -503,326 +1149,401 @@ Suggest appropriate parameters, their values, units, and purposes based on the u
                 with open(error_file, "w") as f:
                     f.write(error_msg + "\n")
                     f.write(traceback.format_exc())
+            
+            # Without HTTP the file-based channel is the only one left, so
+            # keep it running on a loop of its own until the server is stopped
+            if not server.started and not server_stop_event.is_set():
+                print("HTTP server did not start, monitoring command files only")
+                try:
+                    asyncio.run(run_file_monitor_until_stopped())
+                except Exception as e:
+                    print(f"Error in standalone file monitor: {str(e)}")
         
-        # Start the server in a thread
-        uvicorn_thread = threading.Thread(target=uvicorn_thread)
-        uvicorn_thread.daemon = True
-        uvicorn_thread.start()
-        
-        print(f"MCP server started at http://{host}:{port}/sse")
-        
-        # Monitor for command files in a separate thread
-        def file_monitor_thread():
-            try:
-                print("Starting file monitor thread...")
+        # Monitor for command files as a task on the uvicorn event loop.
+        # Blocking file and Fusion work is pushed to worker threads with
+        # asyncio.to_thread so it doesn't stall the SSE endpoint.
+        async def file_monitor_task():
+            # Command files already handled in each directory, so they are
+            # not re-checked for processed/response files on every poll
+            seen_command_files = {comm_dir: set() for comm_dir in comm_dirs}
+            
+            # Directory mtimes at the last scan. Adding, removing or renaming a
+            # file changes the mtime, so an unchanged directory can be skipped.
+            comm_dir_mtimes = {}
+            
+            # Files queued or being handled. A file is only queued once even
+            # if several change events arrive for it. Command files stay here
+            # until their response is written, so they can't run twice;
+            # message_box.txt leaves as soon as it is taken off the queue, so
+            # one rewritten while the last message is shown isn't lost.
+            dispatch_queue = asyncio.Queue()
+            pending_files = set()
+            
+            # Files taken off dispatch_queue, in queue order, each paired with
+            # the task reading it, and the response writes still in flight
+            prepared_queue = asyncio.Queue(maxsize=MONITOR_READ_AHEAD)
+            finishing = set()
+            
+            def claim_message_file(comm_dir):
+                # Returns the message to show, or None if there isn't one
+                message_file = os.path.join(comm_dir, "message_box.txt")
+                debug_file = os.path.join(workspace_comm_dir, "message_box_processing.txt")
+                
+                # Claim the file by renaming it before reading, so a second
+                # scan can't pick up the same message while it is displayed
+                processed_file = os.path.join(
+                    comm_dir, f"processed_message_{os.getpid()}_{int(time.time() * 1e6)}.txt"
+                )
+                try:
+                    os.rename(message_file, processed_file)
+                except FileNotFoundError:
+                    return None
+                
+                try:
+                    # Create debug logs for every step
+                    debug_log.append(debug_file, f"\n--- Found message_box.txt at {time.ctime()} ---\n")
+                    debug_log.append(debug_file, f"Claimed file as: {processed_file}\n")
+                    
+                    # Read the message
+                    with open(processed_file, "r") as f:
+                        message = f.read().strip()
+                    
+                    # Log the message content
+                    debug_log.append(debug_file, f"Message content: {message}\n")
+                    return message
+                except Exception as e:
+                    print(f"Error processing message file {message_file}: {str(e)}")
+                    
+                    # Log the error
+                    debug_log.append(debug_file, f"ERROR processing message file: {str(e)}\n{traceback.format_exc()}")
+                    return None
+            
+            def show_message(message):
+                debug_file = os.path.join(workspace_comm_dir, "message_box_processing.txt")
+                
+                # Queue the message for display
+                print(f"Displaying message box: {message}")
+                
+                # Log that we queued the message
+                debug_log.append(debug_file, "Message being processed via command approach\n")
+                
+                try:
+                    # Use command-based approach for the most reliable display
+                    create_message_box_command(message)
+                    debug_log.append(debug_file, "Command-based display triggered\n")
+                except Exception as e:
+                    debug_log.append(debug_file, f"Command-based display attempt failed: {str(e)}\n")
+            
+            def read_command_file(command_file, processed_file, response_file):
+                # Returns None if the command has already been handled
+                if os.path.exists(processed_file) or os.path.exists(response_file):
+                    return None
+                
+                print(f"Processing command file: {command_file}")
+                return read_json_file(command_file)
+            
+            def run_command(command_id, command_data):
+                command = command_data.get("command")
+                params = command_data.get("params", {})
+                
+                print(f"Processing command {command_id}: {command} with params {params}")
+                
+                # Handle the command
+                handler = COMMAND_HANDLERS.get(command)
+                if handler:
+                    return handler(params, app, workspace_comm_dir)
+                return f"Unknown command: {command}"
+            
+            def finish_command_file(command_file, processed_file, response_file, result):
+                # Write the response; cached resource results are spliced in
+                # without being serialized again
+                if isinstance(result, JSONBytes):
+                    write_json_file(response_file, JSONBytes(b'{"result":' + result + b'}'))
+                else:
+                    write_json_file(response_file, {"result": result})
+                
+                # Rename the command file to avoid processing it again
+                os.rename(command_file, processed_file)
+            
+            def fail_command_file(command_file, response_file, error):
+                print(f"Error processing command file {command_file}: {str(error)}")
+                traceback.print_exception(type(error), error, error.__traceback__)
+                
+                # Try to create an error response anyway
+                try:
+                    write_json_file(response_file, {"error": str(error)})
+                except Exception:
+                    pass
+            
+            def complete_command_file(command_file, processed_file, response_file, result):
+                try:
+                    finish_command_file(command_file, processed_file, response_file, result)
+                except Exception as e:
+                    fail_command_file(command_file, response_file, e)
+            
+            def prepare_command_file(comm_dir, file):
+                # Reads the command and returns the call that runs it in
+                # Fusion, or None if there is nothing to run. That call in
+                # turn returns the call that writes the response.
+                command_file = os.path.join(comm_dir, file)
+                
+                # Extract the command ID from the filename
+                command_id = file.split("_")[1].split(".")[0]
+                
+                processed_file = os.path.join(comm_dir, f"processed_command_{command_id}.json")
+                response_file = os.path.join(comm_dir, f"response_{command_id}.json")
+                
+                # Read command data, checking if we've already processed this command
+                try:
+                    command_data = read_command_file(command_file, processed_file, response_file)
+                except json.JSONDecodeError as e:
+                    # Handle JSON parsing error
+                    print(f"Error parsing JSON in {command_file}: {str(e)}")
+                    write_json_file(response_file, {"error": f"Invalid JSON format: {str(e)}"})
+                    return None
+                except Exception as e:
+                    fail_command_file(command_file, response_file, e)
+                    return None
+                
+                if command_data is None:
+                    return None  # Skip if already processed
+                
+                def dispatch():
+                    try:
+                        result = run_command(command_id, command_data)
+                    except Exception as e:
+                        return functools.partial(fail_command_file, command_file, response_file, e)
+                    return functools.partial(complete_command_file, command_file, processed_file, response_file, result)
+                
+                return dispatch
+            
+            def scan_comm_dir(comm_dir):
+                """Return the (comm_dir, name) pairs in comm_dir that need dispatching."""
+                found = []
+                try:
+                    # Skip directories that haven't changed since the last scan.
+                    # Recent mtimes are always rescanned, as filesystems with
+                    # coarse timestamps can hide a change made in the same tick.
+                    mtime = os.stat(comm_dir).st_mtime_ns
+                    if comm_dir_mtimes.get(comm_dir) == mtime and time.time_ns() - mtime > 2_000_000_000:
+                        return found
+                    comm_dir_mtimes[comm_dir] = mtime
+                    
+                    # A single scandir pass gives every name needed below, so
+                    # no per-file stat calls are required to filter commands
+                    with os.scandir(comm_dir) as entries:
+                        names = {entry.name for entry in entries if entry.is_file()}
+                    
+                    if "message_box.txt" in names:
+                        found.append((comm_dir, "message_box.txt"))
+                    
+                    # Check for command files, skipping ones already handled
+                    seen = seen_command_files[comm_dir]
+                    # Forget files that have gone away so the set stays bounded
+                    seen.intersection_update(names)
+                    for name in sorted(names - seen):
+                        if not (name.startswith("command_") and name.endswith(".json")):
+                            continue
+                        seen.add(name)
+                        
+                        command_id = name[len("command_"):-len(".json")]
+                        if f"processed_command_{command_id}.json" in names or f"response_{command_id}.json" in names:
+                            continue  # Skip if already processed
+                        
+                        found.append((comm_dir, name))
+                except Exception as e:
+                    print(f"Error processing directory {comm_dir}: {str(e)}")
+                    error_file = os.path.join(workspace_comm_dir, "error.txt")
+                    with open(error_file, "w") as f:
+                        f.write(f"Error in file monitor for directory {comm_dir}: {str(e)}\n\n{traceback.format_exc()}")
+                return found
+            
+            def queue_files(files):
+                for item in files:
+                    if item not in pending_files:
+                        pending_files.add(item)
+                        dispatch_queue.put_nowait(item)
+            
+            def watch_filter(change, path):
+                # Only new or rewritten command and message files wake the
+                # monitor; our own responses, .tmp files and debug logs in the
+                # same directories don't
+                if change == Change.deleted:
+                    return False
+                file = os.path.basename(path)
+                return file == "message_box.txt" or (file.startswith("command_") and file.endswith(".json"))
+            
+            def handle_changes(changes):
+                files = [os.path.split(path) for _, path in changes]
                 
-                # Create a file to track thread status
+                # A change batch is an unordered set; queue it the way
+                # scan_comm_dir does, message first and then commands by
+                # name, which is the order they were submitted in
+                files.sort(key=lambda item: (item[1] != "message_box.txt", item[1]))
+                queue_files(files)
+            
+            def prepare_file(comm_dir, file):
+                if file == "message_box.txt":
+                    message = claim_message_file(comm_dir)
+                    return None if message is None else functools.partial(show_message, message)
+                return prepare_command_file(comm_dir, file)
+            
+            async def read_ahead_worker():
+                # Starts reading each file as it is taken off the queue, up to
+                # MONITOR_READ_AHEAD ahead of the one being dispatched
+                while True:
+                    item = await dispatch_queue.get()
+                    if item[1] == "message_box.txt":
+                        # Any later change is a new message; if it is queued
+                        # before this one is claimed, it finds the file gone
+                        pending_files.discard(item)
+                    prepared = asyncio.create_task(asyncio.to_thread(prepare_file, *item))
+                    await prepared_queue.put((item, prepared))
+            
+            def finish_done(item, task):
+                finishing.discard(task)
+                pending_files.discard(item)
+            
+            async def dispatch_worker():
+                # The only task calling into Fusion for files, so commands run
+                # one at a time in the order they were queued. Writing each
+                # response is left running while the next command starts.
+                while True:
+                    item, prepared = await prepared_queue.get()
+                    finish = None
+                    try:
+                        dispatch = await prepared
+                        if dispatch is not None:
+                            finish = await asyncio.to_thread(call_with_fusion_lock, dispatch)
+                    except Exception as e:
+                        print(f"Error dispatching {item[1]}: {str(e)}")
+                    
+                    # A message box rewritten around the time the last one was
+                    # claimed can look unchanged to a polling watcher, so
+                    # check for it again once the message has been handled
+                    if item[1] == "message_box.txt" and os.path.exists(os.path.join(*item)):
+                        queue_files([item])
+                    
+                    if finish is None:
+                        pending_files.discard(item)
+                        continue
+                    task = asyncio.create_task(asyncio.to_thread(finish))
+                    finishing.add(task)
+                    task.add_done_callback(functools.partial(finish_done, item))
+            
+            def ensure_comm_dirs():
+                for comm_dir in comm_dirs:
+                    os.makedirs(comm_dir, exist_ok=True)
+            
+            def start_monitor():
+                # Create a file to track monitor status
                 monitor_file = os.path.join(workspace_comm_dir, "file_monitor_status.txt")
                 with open(monitor_file, "w") as f:
-                    f.write(f"File monitor thread started at {time.ctime()}\n")
+                    f.write(f"File monitor task started at {time.ctime()}\n")
                 
-                while server_running:
-                    # Check each communication directory for command files
-                    for comm_dir in comm_dirs:
-                        try:
-                            # Create directory if it doesn't exist
-                            os.makedirs(comm_dir, exist_ok=True)
-                            
-                            # Check for message box files
-                            message_file = os.path.join(comm_dir, "message_box.txt")
-                            if os.path.exists(message_file):
-                                try:
-                                    # Create debug logs for every step
-                                    debug_file = os.path.join(workspace_comm_dir, "message_box_processing.txt")
-                                    with open(debug_file, "a") as f:
-                                        f.write(f"\n--- Found message_box.txt at {time.ctime()} ---\n")
-                                    
-                                    # Read the message
-                                    with open(message_file, "r") as f:
-                                        message = f.read().strip()
-                                    
-                                    # Log the message content
-                                    with open(debug_file, "a") as f:
-                                        f.write(f"Message content: {message}\n")
-                                    
-                                    # Queue the message for display
-                                    print(f"Displaying message box: {message}")
-                                    
-                                    # Log that we queued the message
-                                    with open(debug_file, "a") as f:
-                                        f.write(f"Message being processed via command approach\n")
-                                    
-                                    # Try to display the message directly as well
-                                    try:
-                                        # Use command-based approach for the most reliable display
-                                        create_message_box_command(message)
-                                        with open(debug_file, "a") as f:
-                                            f.write(f"Command-based display triggered\n")
-                                    except Exception as e:
-                                        with open(debug_file, "a") as f:
-                                            f.write(f"Command-based display attempt failed: {str(e)}\n")
-                                    
-                                    # Rename the file to avoid processing it again
-                                    processed_file = os.path.join(comm_dir, f"processed_message_{int(time.time())}.txt")
-                                    with open(debug_file, "a") as f:
-                                        f.write(f"Renaming file to: {processed_file}\n")
-                                    
-                                    os.rename(message_file, processed_file)
-                                    
-                                    with open(debug_file, "a") as f:
-                                        f.write(f"File renamed successfully\n")
-                                        
-                                except Exception as e:
-                                    print(f"Error processing message file {message_file}: {str(e)}")
-                                    
-                                    # Log the error
-                                    try:
-                                        with open(debug_file, "a") as f:
-                                            f.write(f"ERROR processing message file: {str(e)}\n")
-                                            f.write(traceback.format_exc())
-                                    except:
-                                        pass
-                            
-                            # Check for command files
-                            for file in os.listdir(comm_dir):
-                                if file.startswith("command_") and file.endswith(".json"):
-                                    command_file = os.path.join(comm_dir, file)
-                                    try:
-                                        # Extract the command ID from the filename
-                                        command_id = file.split("_")[1].split(".")[0]
-                                        
-                                        # Check if we've already processed this command
-                                        processed_file = os.path.join(comm_dir, f"processed_command_{command_id}.json")
-                                        response_file = os.path.join(comm_dir, f"response_{command_id}.json")
-                                        
-                                        if os.path.exists(processed_file) or os.path.exists(response_file):
-                                            continue  # Skip if already processed
-                                        
-                                        print(f"Processing command file: {command_file}")
-                                        
-                                        # Read command data
-                                        try:
-                                            with open(command_file, "r") as f:
-                                                command_data = json.load(f)
-                                            
-                                            command = command_data.get("command")
-                                            params = command_data.get("params", {})
-                                            
-                                            print(f"Processing command {command_id}: {command} with params {params}")
-                                            
-                                            result = None
-                                            
-                                            # Handle the command
-                                            if command == "list_resources":
-                                                # Get available resources
-                                                resources = [
-                                                    "fusion://active-document-info",
-                                                    "fusion://design-structure",
-                                                    "fusion://parameters"
-                                                ]
-                                                result = resources
-                                            elif command == "list_tools":
-                                                # Get available tools
-                                                tools = [
-                                                    {"name": "message_box", "description": "Display a message box in Fusion 360"},
-                                                    {"name": "create_new_sketch", "description": "Create a new sketch on the specified plane"},
-                                                    {"name": "create_parameter", "description": "Create a new parameter in the active design"}
-                                                ]
-                                                result = tools
-                                            elif command == "list_prompts":
-                                                # Get available prompts
-                                                prompts = [
-                                                    {"name": "create_sketch_prompt", "description": "Create a prompt for creating a sketch based on a description"},
-                                                    {"name": "parameter_setup_prompt", "description": "Create a prompt for setting up parameters based on a description"}
-                                                ]
-                                                result = prompts
-                                            elif command == "message_box":
-                                                # Display a message box
-                                                message = params.get("message", "")
-                                                
-                                                # Create debug log
-                                    debug_file = os.path.join(workspace_comm_dir, "command_message_debug.txt")
-                                                with open(debug_file, "a") as f:
-                                                    f.write(f"Processing message_box command with: {message} at {time.ctime()}\n")
-                                                
-                                                # Use command-based approach for message display
-                                                try:
-                                                    create_message_box_command(message)
-                                                    with open(debug_file, "a") as f:
-                                                        f.write(f"Command-based display triggered at {time.ctime()}\n")
-                                                except Exception as e:
-                                                    with open(debug_file, "a") as f:
-                                                        f.write(f"Command-based display attempt failed: {str(e)}\n")
-                                                
-                                                result = "Message processed successfully"
-                                            elif command == "create_new_sketch":
-                                                # Create a new sketch
-                                                result = create_new_sketch(params.get("plane_name", "XY"))
-                                            elif command == "create_parameter":
-                                                # Create a new parameter
-                                                result = create_parameter(
-                                                    params.get("name", f"Param_{int(time.time()) % 10000}"),
-                                                    params.get("expression", "10"),
-                                                    params.get("unit", "mm"),
-                                                    params.get("comment", "")
-                                                )
-                                            elif command == "read_resource":
-                                                # Read a resource
-                                                uri = params.get("uri", "")
-                                                if uri == "fusion://active-document-info":
-                                                    try:
-                                                        doc = app.activeDocument
-                                                        if doc:
-                                                            result = {
-                                                                "name": doc.name,
-                                                                "path": doc.dataFile.name if doc.dataFile else "Unsaved",
-                                                                "type": "FusionDesignDocumentType" if doc.products.itemByProductType('DesignProductType') else "Unknown"
-                                                            }
-                                                        else:
-                                                            result = {"error": "No active document"}
-                                                    except Exception as e:
-                                                        result = {"error": str(e)}
-                                                elif uri == "fusion://design-structure":
-                                                    try:
-                                                        doc = app.activeDocument
-                                                        if not doc:
-                                                            result = {"error": "No active document"}
-                                                        else:
-                                                            design = doc.products.itemByProductType('DesignProductType')
-                                                            if not design:
-                                                                result = {"error": "No design in document"}
-                                                            else:
-                                                                # Convert to adsk.fusion.Design type
-                                                                fusion_design = adsk.fusion.Design.cast(design)
-                                                                root_comp = fusion_design.rootComponent
-                                                                
-                                                                # Simplified response with just basic info
-                                                                result = {
-                                                                    "design_name": fusion_design.name,
-                                                                    "root_component": {
-                                                                        "name": root_comp.name,
-                                                                        "bodies_count": root_comp.bodies.count,
-                                                                        "sketches_count": root_comp.sketches.count,
-                                                                        "occurrences_count": root_comp.occurrences.count
-                                                                    }
-                                                                }
-                                                    except Exception as e:
-                                                        result = {"error": str(e)}
-                                                elif uri == "fusion://parameters":
-                                                    try:
-                                                        doc = app.activeDocument
-                                                        if not doc:
-                                                            result = {"error": "No active document"}
-                                                        else:
-                                                            design = doc.products.itemByProductType('DesignProductType')
-                                                            if not design:
-                                                                result = {"error": "No design in document"}
-                                                            else:
-                                                                # Convert to adsk.fusion.Design type
-                                                                fusion_design = adsk.fusion.Design.cast(design)
-                                                                
-                                                                params = []
-                                                                if fusion_design.allParameters:
-                                                                    for param in fusion_design.allParameters:
-                                                                        params.append({
-                                                                            "name": param.name,
-                                                                            "value": param.value,
-                                                                            "expression": param.expression,
-                                                                            "unit": param.unit,
-                                                                            "comment": param.comment
-                                                                        })
-                                                                
-                                                                result = {"parameters": params}
-                                                    except Exception as e:
-                                                        result = {"error": str(e)}
-                                                else:
-                                                    result = {"error": f"Unknown resource URI: {uri}"}
-                                            elif command == "get_prompt":
-                                                # Get a prompt
-                                                prompt_name = params.get("name", "")
-                                                prompt_args = params.get("args", {})
-                                                
-                                                if prompt_name == "create_sketch_prompt":
-                                                    description = prompt_args.get("description", "Default sketch")
-                                                    result = {
-                                                        "messages": [
-                                                            {
-                                                                "role": "system",
-                                                                "content": "You are an expert in Fusion 360 CAD modeling. Your task is to help the user create sketches based on their descriptions.\n\nBe very specific about what planes to use and what sketch entities to create."
-                                                            },
-                                                            {
-                                                                "role": "user",
-                                                                "content": f"I want to create a sketch with these requirements: {description}\n\nPlease provide step-by-step instructions for creating this sketch in Fusion 360."
-                                                            }
-                                                        ]
-                                                    }
-                                                elif prompt_name == "parameter_setup_prompt":
-                                                    description = prompt_args.get("description", "Default parameters")
-                                                    result = {
-                                                        "messages": [
-                                                            {
-                                                                "role": "system",
-                                                                "content": "You are an expert in Fusion 360 parametric design. Your task is to help the user set up parameters for their design.\n\nSuggest appropriate parameters, their values, units, and purposes based on the user's description."
-                                                            },
-                                                            {
-                                                                "role": "user",
-                                                                "content": f"I want to set up parameters for: {description}\n\nWhat parameters should I create, and what values, units, and comments should they have?"
-                                                            }
-                                                        ]
-                                                    }
-                                                else:
-                                                    result = {"error": f"Unknown prompt: {prompt_name}"}
-                                            else:
-                                                result = f"Unknown command: {command}"
-                                            
-                                            # Write the response
-                                            with open(response_file, "w") as f:
-                                                json.dump({"result": result}, f, indent=2)
-                                            
-                                            # Rename the command file to avoid processing it again
-                                            os.rename(command_file, processed_file)
-                                        except json.JSONDecodeError as e:
-                                            # Handle JSON parsing error
-                                            print(f"Error parsing JSON in {command_file}: {str(e)}")
-                                            with open(response_file, "w") as f:
-                                                json.dump({"error": f"Invalid JSON format: {str(e)}"}, f, indent=2)
-                                    except Exception as e:
-                                        print(f"Error processing command file {command_file}: {str(e)}")
-                                        traceback.print_exc()
-                                        
-                                        # Try to create an error response anyway
-                                        try:
-                                            with open(os.path.join(comm_dir, f"response_{command_id}.json"), "w") as f:
-                                                json.dump({"error": str(e)}, f, indent=2)
-                                        except Exception:
-                                            pass
-                        except Exception as e:
-                            print(f"Error processing directory {comm_dir}: {str(e)}")
-                            error_file = os.path.join(workspace_comm_dir, "error.txt")
-                            with open(error_file, "w") as f:
-                                f.write(f"Error in file monitor for directory {comm_dir}: {str(e)}\n\n{traceback.format_exc()}")
-                    
-                    # Sleep to avoid high CPU usage
-                    time.sleep(0.5)
+                # Create the communication directories once up front
+                ensure_comm_dirs()
+                
+                # Pick up anything written before the monitor started
+                files = []
+                for comm_dir in comm_dirs:
+                    files.extend(scan_comm_dir(comm_dir))
+                return files
+            
+            workers = []
+            try:
+                print("Starting file monitor task...")
+                workers = [asyncio.create_task(read_ahead_worker()), asyncio.create_task(dispatch_worker())]
+                queue_files(await asyncio.to_thread(start_monitor))
+                
+                if awatch is not None:
+                    # Sleep until native change notifications arrive and hand
+                    # the files to the workers; the task is cancelled when the
+                    # server shuts down. Set FUSION_MCP_FORCE_POLLING for
+                    # filesystems (e.g. network shares) that don't deliver
+                    # change events.
+                    force_polling = bool(os.getenv("FUSION_MCP_FORCE_POLLING")) or None
+                    async for changes in awatch(*comm_dirs, watch_filter=watch_filter, force_polling=force_polling):
+                        handle_changes(changes)
+                else:
+                    # watchfiles is not installed, fall back to polling.
+                    # The directories are only re-created occasionally in
+                    # case one was removed while the server was running.
+                    dirs_checked_at = time.monotonic()
+                    while not server_stop_event.is_set():
+                        if time.monotonic() - dirs_checked_at >= 60:
+                            await asyncio.to_thread(ensure_comm_dirs)
+                            dirs_checked_at = time.monotonic()
+                        
+                        # Check each communication directory for command files
+                        for comm_dir in comm_dirs:
+                            queue_files(await asyncio.to_thread(scan_comm_dir, comm_dir))
+                        
+                        # Sleep to avoid high CPU usage
+                        await asyncio.sleep(0.5)
             except Exception as e:
-                print(f"Error in file monitor thread: {str(e)}")
+                print(f"Error in file monitor task: {str(e)}")
                 error_file = os.path.join(workspace_comm_dir, "error.txt")
                 with open(error_file, "w") as f:
                     f.write(f"File Monitor Error: {str(e)}\n\n{traceback.format_exc()}")
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                # Let responses already being written finish
+                await asyncio.gather(*finishing, return_exceptions=True)
+                debug_log.flush()
+        
+        async def cancel_file_monitor(file_monitor):
+            file_monitor.cancel()
+            try:
+                await file_monitor
+            except asyncio.CancelledError:
+                pass
+        
+        # Run the file monitor alongside the server on its event loop while
+        # the app's lifespan is up, wrapping whatever lifespan it already has
+        app_lifespan = sse_app.router.lifespan_context
+        
+        @contextlib.asynccontextmanager
+        async def lifespan(app):
+            async with app_lifespan(app) as state:
+                file_monitor = asyncio.create_task(file_monitor_task())
+                try:
+                    yield state
+                finally:
+                    await cancel_file_monitor(file_monitor)
+        
+        sse_app.router.lifespan_context = lifespan
+        
+        # Used by uvicorn_thread when the server never started
+        async def run_file_monitor_until_stopped():
+            file_monitor = asyncio.create_task(file_monitor_task())
+            await asyncio.to_thread(server_stop_event.wait)
+            await cancel_file_monitor(file_monitor)
+        
+        # Wait for the startup files before accepting connections
+        startup_executor.shutdown(wait=True)
+        for task in startup_tasks:
+            task.result()
+        
+        # Start the server in a thread
+        uvicorn_thread = threading.Thread(target=uvicorn_thread)
+        uvicorn_thread.daemon = True
+        uvicorn_thread.start()
         
-        # Start the file monitor thread
-        file_monitor = threading.Thread(target=file_monitor_thread)
-        file_monitor.daemon = True
-        file_monitor.start()
+        print(f"MCP server started at http://{host}:{port}/sse")
         
-        # Keep thread running
-        while server_running:
-            time.sleep(1)
+        # Keep thread running until the server is stopped
+        server_stop_event.wait()
             
         # Shutdown the server
         print("Shutting down server...")
         server.should_exit = True
         
+        if message_tool_listener:
+            message_tool_listener.stop()
+        
         return True
         
     except Exception as e:
@@ -841,7 +1562,6 @@ Suggest appropriate parameters, their values, units, and purposes based on the u
 # Function to start the server
 def start_server():
     global server_thread
-    global server_running
     
     print("Starting MCP server...")
     
@@ -861,12 +1581,12 @@ def start_server():
         return False
     
     # Check if server is already running
-    if server_running and server_thread and server_thread.is_alive():
+    if not server_stop_event.is_set() and server_thread and server_thread.is_alive():
         print("MCP server is already running")
         return True
     
     # Reset server state
-    server_running = True
+    server_stop_event.clear()
     
     # Start server in a separate thread
     def server_thread_func():
@@ -874,11 +1594,11 @@ def start_server():
             success = run_mcp_server()
             if not success:
                 print("Failed to start MCP server")
-                server_running = False
+                server_stop_event.set()
                 ui.messageBox("Failed to start MCP server. See error log for details.")
         except Exception as e:
             print(f"Error in server thread: {str(e)}")
-            server_running = False
+            server_stop_event.set()
             error_file = os.path.join(workspace_comm_dir, "mcp_server_error.txt")
             with open(error_file, "w") as f:
                 f.write(f"MCP Server Thread Error: {str(e)}\n\n{traceback.format_exc()}")
@@ -895,7 +1615,7 @@ def start_server():
     # Check if the thread is still alive
     if not server_thread.is_alive():
         print("MCP server thread stopped unexpectedly")
-        server_running = False
+        server_stop_event.set()
         return False
     
     print("MCP server started successfully")
@@ -903,19 +1623,18 @@ def start_server():
 
 # Function to stop the server
 def stop_server():
-    global server_running
-    
-    if not server_running:
+    if server_stop_event.is_set():
         print("MCP server is not running")
         return
     
-    # Set server running flag to stop the server loop
-    server_running = False
+    # Wake the server thread so it shuts down
+    server_stop_event.set()
     
     # Wait for the thread to finish
     if server_thread and server_thread.is_alive():
         server_thread.join(timeout=2.0)
     
+    debug_log.flush()
     print("MCP server stopped")
 
 # Command event handlers
@@ -933,17 +1652,12 @@ class MCPServerCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
             info_input = inputs.addTextBoxCommandInput('infoInput', '', 
                 'Click OK to start the MCP Server.\n\n' +
                 'This will enable communication between Fusion 360 and MCP clients.\n\n' +
-                'Current server status: ' + ('Running' if server_running else 'Not Running'), 
+                'Current server status: ' + ('Not Running' if server_stop_event.is_set() else 'Running'), 
                 4, True)
             
             # Events
-            onExecute = MCPServerCommandExecuteHandler()
-            cmd.execute.add(onExecute)
-            handlers.append(onExecute)
-            
-            onDestroy = MCPServerCommandDestroyHandler()
-            cmd.destroy.add(onDestroy)
-            handlers.append(onDestroy)
+            cmd.execute.add(_cmd_execute_handler)
+            cmd.destroy.add(_cmd_destroy_handler)
         except:
             if ui:
                 ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
@@ -960,17 +1674,14 @@ class MCPServerCommandExecuteHandler(adsk.core.CommandEventHandler):
             # Try to show a test message directly for debugging
             workspace_path, workspace_comm_dir = get_workspace_paths()
             debug_path = os.path.join(workspace_comm_dir, "execute_debug.txt")
-            with open(debug_path, "a") as f:
-                f.write(f"Execute handler called at {time.ctime()}\n")
-                f.write(f"Trying command-based test message\n")
+            debug_log.append(debug_path, f"Execute handler called at {time.ctime()}\n")
+            debug_log.append(debug_path, f"Trying command-based test message\n")
             
             try:
                 create_message_box_command("MCP Server started - Test Message")
-                with open(debug_path, "a") as f:
-                    f.write(f"Command-based test message triggered at {time.ctime()}\n")
+                debug_log.append(debug_path, f"Command-based test message triggered at {time.ctime()}\n")
             except Exception as e:
-                with open(debug_path, "a") as f:
-                    f.write(f"Command-based test message failed: {str(e)} at {time.ctime()}\n")
+                debug_log.append(debug_path, f"Command-based test message failed: {str(e)} at {time.ctime()}\n")
             
             if success:
                 workspace_path, workspace_comm_dir = get_workspace_paths()
@@ -1014,14 +1725,39 @@ class MCPServerCommandDestroyHandler(adsk.core.CommandEventHandler):
             if ui:
                 ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
 
+# One instance of each command handler, shared by every time the command runs
+_cmd_created_handler = MCPServerCommandCreatedHandler()
+_cmd_execute_handler = MCPServerCommandExecuteHandler()
+_cmd_destroy_handler = MCPServerCommandDestroyHandler()
+
+class DocumentChangedHandler(adsk.core.DocumentEventHandler):
+    def __init__(self):
+        super().__init__()
+    
+    def notify(self, args):
+        try:
+            clear_resource_caches()
+        except:
+            if ui:
+                ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
+class CommandTerminatedHandler(adsk.core.ApplicationCommandEventHandler):
+    def __init__(self):
+        super().__init__()
+    
+    def notify(self, args):
+        try:
+            clear_resource_caches()
+        except:
+            if ui:
+                ui.messageBox('Failed:\n{}'.format(traceback.format_exc()))
+
 # Function to stop server on add-in stop
 def stop_server_on_stop(context):
     try:
-        global server_running
-        
-        if server_running:
+        if not server_stop_event.is_set():
             print("Stopping MCP server...")
-            server_running = False
+            server_stop_event.set()
             
             # Create a shutdown log file
             workspace_path, workspace_comm_dir = get_workspace_paths()
@@ -1035,6 +1771,7 @@ def stop_server_on_stop(context):
             if server_thread and server_thread.is_alive():
                 server_thread.join(timeout=2.0)
             
+            debug_log.flush()
             print("MCP server stopped")
     except:
         if ui:
@@ -1042,6 +1779,7 @@ def stop_server_on_stop(context):
 
 # Function to create the UI elements
 def create_ui():
+    global message_box_event
     try:
         # Get the command definitions
         command_definitions = ui.commandDefinitions
@@ -1052,9 +1790,25 @@ def create_ui():
             mcp_server_cmd_def = command_definitions.addButtonDefinition('MCPServerCommand', 'MCP Server', 'Start the MCP Server for Fusion 360')
         
         # Connect to the command created event
-        on_command_created = MCPServerCommandCreatedHandler()
-        mcp_server_cmd_def.commandCreated.add(on_command_created)
-        handlers.append(on_command_created)
+        mcp_server_cmd_def.commandCreated.add(_cmd_created_handler)
+        
+        # Drop cached resource payloads when the active document changes
+        on_document_changed = DocumentChangedHandler()
+        app.documentActivated.add(on_document_changed)
+        app.documentSaved.add(on_document_changed)
+        app.documentClosed.add(on_document_changed)
+        handlers.append(on_document_changed)
+        
+        # ...and when any UI command finishes, since it may have edited the design
+        on_command_terminated = CommandTerminatedHandler()
+        ui.commandTerminated.add(on_command_terminated)
+        handlers.append(on_command_terminated)
+        
+        # Message boxes requested from server threads are shown through this event
+        message_box_event = app.registerCustomEvent(MESSAGE_BOX_EVENT_ID)
+        on_message_box_event = MessageBoxCustomEventHandler()
+        message_box_event.add(on_message_box_event)
+        handlers.append(on_message_box_event)
         
         # Add to the add-ins panel
         add_ins_panel = ui.allToolbarPanels.itemById('SolidScriptsAddinsPanel')
@@ -1078,10 +1832,28 @@ def start():
 
 def stop():
     """Called when the add-in is stopped."""
+    global message_box_event
     try:
         # Stop the server
         stop_server_on_stop(None)
+
+        # Disconnect the cache invalidation handlers
+        for handler in handlers:
+            if isinstance(handler, DocumentChangedHandler):
+                app.documentActivated.remove(handler)
+                app.documentSaved.remove(handler)
+                app.documentClosed.remove(handler)
+            elif isinstance(handler, CommandTerminatedHandler):
+                ui.commandTerminated.remove(handler)
+            elif isinstance(handler, MessageBoxCustomEventHandler) and message_box_event:
+                message_box_event.remove(handler)
+        handlers.clear()
         
+        # Unregister the message box event
+        if message_box_event:
+            app.unregisterCustomEvent(MESSAGE_BOX_EVENT_ID)
+            message_box_event = None
+
         # Clean up UI
         command_definitions = ui.commandDefinitions
         mcp_server_cmd_def = command_definitions.itemById('MCPServerCommand')
@@ -1093,6 +1865,10 @@ def stop():
         control = add_ins_panel.controls.itemById('MCPServerCommand')
         if control:
             control.deleteMe()
+        
+        # Stop the debug log writer; the module is imported again on restart
+        atexit.unregister(debug_log.close)
+        debug_log.close()
             
         print("MCP Server add-in stopped")
     except:
@@ -1107,19 +1883,41 @@ def run(context):
         if ui:
             ui.messageBox('Failed to run:\n{}'.format(traceback.format_exc()))
 
+# Debug log shared by the message box command and its handlers
+_message_command_debug_file = None
+
+def get_message_command_debug_file():
+    """Return the path of message_command_debug.txt, resolved on first use."""
+    global _message_command_debug_file
+    if _message_command_debug_file is None:
+        _, workspace_comm_dir = get_workspace_paths()
+        _message_command_debug_file = os.path.join(workspace_comm_dir, "message_command_debug.txt")
+    return _message_command_debug_file
+
 # Function to create a message box command
 def create_message_box_command(message):
     try:
-        _, workspace_comm_dir = get_workspace_paths()
-        debug_file = os.path.join(workspace_comm_dir, "message_command_debug.txt")
-        with open(debug_file, "a") as f:
-            f.write(f"\nCreating message box command for: {message} at {time.ctime()}\n")
+        ts = time.ctime()
+        debug_file = get_message_command_debug_file()
+        debug_log.append(debug_file, f"\nCreating message box command for: {message} at {ts}\n")
+        
+        # Hand the message to the UI thread through the custom event when it
+        # is registered; Fusion queues it and MessageBoxCustomEventHandler
+        # shows it, so no command definition is needed
+        if message_box_event:
+            app.fireCustomEvent(MESSAGE_BOX_EVENT_ID, to_json({"message": message}))
+            debug_log.append(debug_file, f"Message box event fired at {ts}\n")
+            return True
         
-        # Create a unique command ID
+        # Otherwise fall back to a one-off command. Create a unique command ID
         command_id = f"MCPMessageBox_{int(time.time() * 1000)}"
         
         # Get or create the command definition
         cmdDefs = ui.commandDefinitions
+        while finished_message_commands:
+            finished_def = cmdDefs.itemById(finished_message_commands.pop())
+            if finished_def:
+                finished_def.deleteMe()
         cmdDef = cmdDefs.itemById(command_id)
         if cmdDef:
             cmdDef.deleteMe()
@@ -1133,25 +1931,27 @@ def create_message_box_command(message):
         )
         
         # Connect to the command created event
-        onCommandCreated = MessageBoxCommandCreatedHandler(message)
+        onCommandCreated = MessageBoxCommandCreatedHandler(message, command_id)
         cmdDef.commandCreated.add(onCommandCreated)
-        message_command_handlers.append(onCommandCreated)
+        if len(message_command_handlers) == message_command_handlers.maxlen:
+            oldest_id, _ = message_command_handlers[0]
+            oldest_def = cmdDefs.itemById(oldest_id)
+            if oldest_def:
+                oldest_def.deleteMe()
+        message_command_handlers.append((command_id, onCommandCreated))
         
-        with open(debug_file, "a") as f:
-            f.write(f"Command definition created with ID: {command_id} at {time.ctime()}\n")
+        debug_log.append(debug_file, f"Command definition created with ID: {command_id} at {ts}\n")
         
         # Execute the command
         cmdDef.execute()
         
-        with open(debug_file, "a") as f:
-            f.write(f"Command execution triggered at {time.ctime()}\n")
+        debug_log.append(debug_file, f"Command execution triggered at {time.ctime()}\n")
         
         return True
     except Exception as e:
         try:
-            with open(debug_file, "a") as f:
-                f.write(f"Error creating message box command: {str(e)} at {time.ctime()}\n")
-                f.write(traceback.format_exc())
+            debug_log.append(debug_file, f"Error creating message box command: {str(e)} at {time.ctime()}\n")
+            debug_log.append(debug_file, traceback.format_exc())
         except:
             pass
         return False
@@ -1163,74 +1963,109 @@ def show_message_box(message):
         # Log message for debugging
         _, workspace_comm_dir = get_workspace_paths()
         debug_path = os.path.join(workspace_comm_dir, "message_debug.txt")
-        with open(debug_path, "a") as f:
-            f.write(f"Trying to show message: {message} at {time.ctime()}\n")
+        debug_log.append(debug_path, f"Trying to show message: {message} at {time.ctime()}\n")
         
         # Use the command-based approach
         success = create_message_box_command(message)
         
         # Log result
-        with open(debug_path, "a") as f:
-            f.write(f"Command creation result: {success} at {time.ctime()}\n")
+        debug_log.append(debug_path, f"Command creation result: {success} at {time.ctime()}\n")
         
         return success
     except Exception as e:
         # Log failure
-        with open(debug_path, "a") as f:
-            f.write(f"Error showing message box: {str(e)} at {time.ctime()}\n")
+        debug_log.append(debug_path, f"Error showing message box: {str(e)} at {time.ctime()}\n")
         return False
 
+# Shows the messages passed to create_message_box_command on the UI thread
+class MessageBoxCustomEventHandler(adsk.core.CustomEventHandler):
+    def __init__(self):
+        super().__init__()
+    
+    def notify(self, args):
+        try:
+            debug_file = get_message_command_debug_file()
+            
+            message = json.loads(args.additionalInfo)["message"]
+            debug_log.append(debug_file, f"Message box event received for: {message} at {time.ctime()}\n")
+            
+            ui.messageBox(message, "Fusion MCP Message")
+            
+            # messageBox is modal, so this is when the user closed it
+            debug_log.append(debug_file, f"Message box displayed successfully at {time.ctime()}\n")
+        except Exception as e:
+            # debug_file may not be resolved yet if finding the workspace failed
+            try:
+                debug_log.append(debug_file, f"Error in message box event handler: {str(e)} at {time.ctime()}\n")
+                debug_log.append(debug_file, traceback.format_exc())
+            except:
+                pass
+
+def forget_message_command(command_id):
+    """Release the handlers of a finished fallback message box command."""
+    for entry in message_command_handlers:
+        if entry[0] == command_id:
+            message_command_handlers.remove(entry)
+            break
+    finished_message_commands.append(command_id)
+
 # Add a Command Handler for showing message boxes
 class MessageBoxCommandExecuteHandler(adsk.core.CommandEventHandler):
-    def __init__(self, message):
+    def __init__(self, message, command_id):
         super().__init__()
         self.message = message
+        self.command_id = command_id
     
     def notify(self, args):
         try:
             # Display the message
-            _, workspace_comm_dir = get_workspace_paths()
-            debug_file = os.path.join(workspace_comm_dir, "message_command_debug.txt")
-            with open(debug_file, "a") as f:
-                f.write(f"MessageBoxCommand executing for: {self.message} at {time.ctime()}\n")
+            debug_file = get_message_command_debug_file()
+            debug_log.append(debug_file, f"MessageBoxCommand executing for: {self.message} at {time.ctime()}\n")
             
             # Show the message box in the UI thread
             ui.messageBox(self.message, "Fusion MCP Message")
             
-            with open(debug_file, "a") as f:
-                f.write(f"Message box displayed successfully at {time.ctime()}\n")
+            # messageBox is modal, so this is when the user closed it
+            debug_log.append(debug_file, f"Message box displayed successfully at {time.ctime()}\n")
         except Exception as e:
-            with open(debug_file, "a") as f:
-                f.write(f"Error in command handler: {str(e)} at {time.ctime()}\n")
-                f.write(traceback.format_exc())
+            # debug_file may not be resolved yet if finding the workspace failed
+            try:
+                debug_log.append(debug_file, f"Error in command handler: {str(e)} at {time.ctime()}\n")
+                debug_log.append(debug_file, traceback.format_exc())
+            except:
+                pass
+        finally:
+            forget_message_command(self.command_id)
 
 class MessageBoxCommandCreatedHandler(adsk.core.CommandCreatedEventHandler):
-    def __init__(self, message):
+    def __init__(self, message, command_id):
         super().__init__()
         self.message = message
+        self.command_id = command_id
     
     def notify(self, args):
         try:
-            _, workspace_comm_dir = get_workspace_paths()
-            debug_file = os.path.join(workspace_comm_dir, "message_command_debug.txt")
-            with open(debug_file, "a") as f:
-                f.write(f"MessageBoxCommand created for: {self.message} at {time.ctime()}\n")
+            ts = time.ctime()
+            debug_file = get_message_command_debug_file()
+            debug_log.append(debug_file, f"MessageBoxCommand created for: {self.message} at {ts}\n")
             
             # Get the command
             cmd = args.command
             
             # Connect to the execute event
-            onExecute = MessageBoxCommandExecuteHandler(self.message)
+            onExecute = MessageBoxCommandExecuteHandler(self.message, self.command_id)
             cmd.execute.add(onExecute)
-            message_command_handlers.append(onExecute)
+            self.execute_handler = onExecute  # Kept alive along with this handler
             
             # Set command properties
             cmd.isEnabled = True
             cmd.isVisible = False
             
-            with open(debug_file, "a") as f:
-                f.write(f"Command handlers set up at {time.ctime()}\n")
+            debug_log.append(debug_file, f"Command handlers set up at {ts}\n")
         except Exception as e:
-            with open(debug_file, "a") as f:
-                f.write(f"Error in command created handler: {str(e)} at {time.ctime()}\n")
-                f.write(traceback.format_exc()) 
\ No newline at end of file
+            # debug_file may not be resolved yet if finding the workspace failed
+            try:
+                debug_log.append(debug_file, f"Error in command created handler: {str(e)} at {time.ctime()}\n")
+                debug_log.append(debug_file, traceback.format_exc())
+            except:
+                pass
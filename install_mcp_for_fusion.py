@@ -7,44 +7,30 @@ It attempts to locate all Fusion 360 Python executables and install MCP for each
 
 import os
 import sys
+import argparse
 import subprocess
-import glob
 import winreg
 import ctypes
+import io
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+# Import names of the packages installed by install_mcp: mcp and typer for
+# mcp[cli]; uvicorn and, except uvloop (not used on Windows), its standard
+# extras; and orjson. An install is only skipped when all of them are there.
+INSTALLED_PACKAGES = (
+    "mcp", "typer", "uvicorn", "httptools", "watchfiles", "websockets", "dotenv", "yaml", "orjson"
+)
+
 def is_admin():
     """Check if the script is running with admin privileges"""
     try:
         return ctypes.windll.shell32.IsUserAnAdmin()
-    except:
+    except (AttributeError, OSError):
         return False
 
 def find_fusion_python_paths():
     """Find potential Fusion 360 Python paths"""
-    paths = []
-    
-    # Try to find Fusion 360 install location from Windows registry
-    try:
-        key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall")
-        for i in range(winreg.QueryInfoKey(key)[0]):
-            try:
-                subkey_name = winreg.EnumKey(key, i)
-                subkey = winreg.OpenKey(key, subkey_name)
-                try:
-                    display_name = winreg.QueryValueEx(subkey, "DisplayName")[0]
-                    if "Fusion 360" in display_name:
-                        install_location = winreg.QueryValueEx(subkey, "InstallLocation")[0]
-                        paths.append(install_location)
-                except:
-                    pass
-                winreg.CloseKey(subkey)
-            except:
-                continue
-        winreg.CloseKey(key)
-    except:
-        pass
-    
     # Common Fusion 360 install locations
     common_locations = [
         os.path.expanduser("~\\AppData\\Local\\Autodesk\\webdeploy"),
@@ -53,104 +39,178 @@ def find_fusion_python_paths():
         os.path.expanduser("~\\AppData\\Local\\Autodesk\\Fusion 360")
     ]
     
-    # Add common locations to search paths
-    paths.extend(common_locations)
+    # The registry and filesystem scans touch unrelated subsystems and both
+    # release the GIL while waiting, so the common locations are walked while
+    # the registry is enumerated. Registry hits are walked afterwards, skipping
+    # any that are one of the common locations
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        registry_future = executor.submit(_scan_registry)
+        common_future = executor.submit(_scan_filesystem, common_locations)
+        registry_paths = _scan_filesystem(registry_future.result(), skip=common_locations)
+        common_paths = common_future.result()
+    
+    return list(dict.fromkeys(registry_paths + common_paths))
+
+def _scan_registry():
+    """Return the Fusion 360 install locations listed in the Windows registry"""
+    paths = []
+    seen = set()
+    
+    # Only DisplayName is read for most entries; InstallLocation is looked
+    # up just for the Fusion 360 ones.
+    try:
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Windows\CurrentVersion\Uninstall") as key:
+            for i in range(winreg.QueryInfoKey(key)[0]):
+                try:
+                    subkey_name = winreg.EnumKey(key, i)
+                    with winreg.OpenKey(key, subkey_name) as subkey:
+                        try:
+                            display_name = winreg.QueryValueEx(subkey, "DisplayName")[0]
+                        except FileNotFoundError:
+                            continue
+                        if not isinstance(display_name, str) or "Fusion 360" not in display_name:
+                            continue
+                        install_location = winreg.QueryValueEx(subkey, "InstallLocation")[0]
+                        if install_location not in seen:
+                            seen.add(install_location)
+                            paths.append(install_location)
+                except OSError:
+                    continue
+    except OSError:
+        pass
     
-    # Look for Python executable in Fusion paths
+    return paths
+
+def _scan_filesystem(base_paths, skip=()):
+    """Find Python executables below base_paths, walking each directory only once"""
+    # The registry often points at one of the common locations, so paths are
+    # compared in their canonical form
     python_paths = []
-    for base_path in paths:
-        if os.path.exists(base_path):
-            # Search for Python executable in production directories
-            for prod_dir in glob.glob(os.path.join(base_path, "production", "*")):
-                python_path = os.path.join(prod_dir, "Python", "python.exe")
-                if os.path.exists(python_path):
-                    python_paths.append(python_path)
-            
-            # Try common subdirectory patterns
-            python_glob_patterns = [
-                os.path.join(base_path, "*", "*", "Python", "python.exe"),
-                os.path.join(base_path, "*", "Python", "python.exe"),
-                os.path.join(base_path, "Python", "python.exe")
-            ]
-            
-            for pattern in python_glob_patterns:
-                for path in glob.glob(pattern):
-                    if os.path.exists(path) and path not in python_paths:
-                        python_paths.append(path)
+    seen = set()
+    base_paths_seen = {os.path.normcase(os.path.normpath(p)) for p in skip}
+    for base_path in base_paths:
+        key = os.path.normcase(os.path.normpath(base_path))
+        if key in base_paths_seen:
+            continue
+        base_paths_seen.add(key)
+        for python_path in _find_python_exes(base_path):
+            if python_path not in seen:
+                seen.add(python_path)
+                python_paths.append(python_path)
     
     return python_paths
 
-def install_mcp(python_path):
-    """Install MCP using the specified Python executable"""
-    try:
-        print(f"\nAttempting to install MCP using: {python_path}")
-        
-        # Check if pip is available
+def _find_python_exes(base_path, max_depth=3):
+    """Yield each Python\\python.exe at most max_depth directories below base_path"""
+    stack = [(base_path, 0)]
+    while stack:
+        path, depth = stack.pop()
         try:
-            subprocess.run([python_path, "-m", "pip", "--version"], check=True, capture_output=True)
-        except subprocess.CalledProcessError:
-            print("Pip not available. Attempting to install pip first...")
-            subprocess.run([python_path, "-m", "ensurepip", "--upgrade"], check=True)
+            entries = os.scandir(path)
+        except OSError:
+            continue
+        
+        with entries:
+            for entry in entries:
+                try:
+                    if not entry.is_dir(follow_symlinks=False):
+                        continue
+                    # The executable sits directly in the Python directory, so
+                    # a single stat finds it without listing (or descending
+                    # into) the interpreter's large Lib tree
+                    if entry.name.lower() == "python":
+                        python_exe = os.path.join(entry.path, "python.exe")
+                        if os.path.isfile(python_exe):
+                            yield python_exe
+                    elif depth + 1 < max_depth:
+                        stack.append((entry.path, depth + 1))
+                except OSError:
+                    continue
+
+def install_mcp(python_path, upgrade=False):
+    """Install MCP using the specified Python executable.
+    
+    With upgrade, pip runs even if everything is already installed and
+    upgrades the packages to their latest versions.
+    """
+    # Output is collected and printed in one block at the end, so installs
+    # running in parallel don't interleave their output
+    out = io.StringIO()
+    
+    def log(*args):
+        print(*args, file=out)
+    
+    try:
+        log(f"\nAttempting to install MCP using: {python_path}")
         
-        # Install MCP with CLI extras
-        result = subprocess.run(
-            [python_path, "-m", "pip", "install", "mcp[cli]"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        # Re-running the installer shouldn't pay for pip's resolve and index
+        # requests when everything it installs is already there
+        site_packages = os.path.join(os.path.dirname(python_path), "Lib", "site-packages")
+        if not upgrade and all(os.path.isdir(os.path.join(site_packages, package)) for package in INSTALLED_PACKAGES):
+            log("MCP and its dependencies are already installed, skipping (use --upgrade to update them).")
+            return True
         
-        print("Installation output:")
-        print(result.stdout)
+        # Install MCP with CLI extras together with uvicorn, which the server
+        # needs, in one pip run so dependencies are resolved once. The
+        # standard extras bring in uvloop (where supported) and httptools for
+        # the SSE endpoint, and orjson speeds up the JSON responses. Wheels
+        # are preferred so pip doesn't build sdists, which can need a compiler
+        install_command = [
+            python_path, "-m", "pip", "install", "--disable-pip-version-check", "--no-input",
+            "--prefer-binary", "mcp[cli]", "uvicorn[standard]", "orjson"
+        ]
+        if upgrade:
+            install_command.append("--upgrade")
         
-        if result.stderr:
-            print("Errors/Warnings:")
-            print(result.stderr)
+        # Fusion's Python normally ships pip; checking for its package on disk
+        # is much cheaper than starting the interpreter to find out
+        if not os.path.isfile(os.path.join(site_packages, "pip", "__init__.py")):
+            log("Pip not available. Attempting to install pip first...")
+            subprocess.run([python_path, "-m", "ensurepip", "--upgrade"], capture_output=True, check=True)
         
-        # Also install uvicorn required by the server
+        # Try wheels only first; fall back to allowing source builds only if
+        # something has no wheel for Fusion's Python. Any other failure
+        # (network, permissions, conflicts) would just fail again.
         try:
-            result_uvicorn = subprocess.run(
-                [python_path, "-m", "pip", "install", "uvicorn"],
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            print("uvicorn installation output:")
-            print(result_uvicorn.stdout)
-            if result_uvicorn.stderr:
-                print("uvicorn Errors/Warnings:")
-                print(result_uvicorn.stderr)
+            subprocess.run(install_command + ["--only-binary=:all:"], capture_output=True, check=True)
         except subprocess.CalledProcessError as e:
-            print("Warning: Failed to install uvicorn. The add-in may not start the HTTP server.")
-            print(e.stdout)
-            print(e.stderr)
-
-        # Verify installation - just check if we can import mcp and uvicorn without error
-        verify = subprocess.run(
-            [python_path, "-c", "import mcp, uvicorn; print('MCP and uvicorn installed successfully!')"],
-            capture_output=True,
-            text=True
-        )
+            if b"No matching distribution found" not in (e.stderr or b""):
+                raise
+            log("Binary-only install failed:")
+            log(e.stderr.decode("utf-8", "replace"))
+            log("Retrying with source builds allowed...")
+            subprocess.run(install_command, capture_output=True, check=True)
         
-        if verify.returncode == 0:
-            print("Verification output:")
-            print(verify.stdout)
-            return True
-        else:
-            print("Verification failed:")
-            print(verify.stderr)
-            return False
+        # pip exits non-zero (raising above) if any package failed to install.
+        # Its output is kept as bytes and only decoded when something failed
+        log("MCP and uvicorn installed successfully!")
+        return True
             
     except subprocess.CalledProcessError as e:
-        print("Error during installation:")
-        print(e.stdout)
-        print(e.stderr)
+        log("Error during installation:")
+        log((e.stdout or b"").decode("utf-8", "replace"))
+        log((e.stderr or b"").decode("utf-8", "replace"))
         return False
     except Exception as e:
-        print(f"Error: {str(e)}")
+        log(f"Error: {str(e)}")
         return False
+    finally:
+        print(out.getvalue(), end="", flush=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Install MCP for Fusion 360's Python environments")
+    parser.add_argument("--yes", "-y", action="store_true",
+                        help="don't prompt for confirmation or wait for Enter at the end")
+    parser.add_argument("--python", action="append", metavar="PATH",
+                        help="python.exe to install into instead of searching (can be repeated)")
+    parser.add_argument("--upgrade", action="store_true",
+                        help="run pip even where everything is already installed, upgrading the packages")
+    return parser.parse_args()
 
 def main():
+    """Run the installer and return the process exit status (0 on success)."""
+    args = parse_args()
+    
     print("=== MCP Installer for Fusion 360 ===")
     print("This script will install the MCP package for ALL detected Fusion 360 Python environments.")
     
@@ -159,12 +219,24 @@ def main():
         print("Note: Some installation paths may require administrator privileges.")
         print("If installation fails, try running this script as administrator.")
     
-    # Find Python paths
-    print("\nSearching for Fusion 360 Python installations...")
-    python_paths = find_fusion_python_paths()
+    # Find Python paths, unless they were given on the command line
+    if args.python:
+        python_paths = list(dict.fromkeys(args.python))
+        missing_paths = [path for path in python_paths if not os.path.isfile(path)]
+        if missing_paths:
+            for path in missing_paths:
+                print(f"Path does not exist: {path}")
+            print("\nExiting without installation.")
+            return 1
+    else:
+        print("\nSearching for Fusion 360 Python installations...")
+        python_paths = find_fusion_python_paths()
     
     if not python_paths:
         print("No Fusion 360 Python installations found automatically.")
+        if args.yes:
+            print("\nExiting without installation. Use --python to give the path to python.exe.")
+            return 1
         custom_path = input("\nEnter the full path to Fusion 360's python.exe (or press Enter to exit): ")
         if custom_path and os.path.exists(custom_path):
             python_paths = [custom_path]
@@ -172,7 +244,7 @@ def main():
             if custom_path:
                 print(f"Path does not exist: {custom_path}")
             print("\nExiting without installation.")
-            return
+            return 1
     
     # Display found paths
     print(f"\nFound {len(python_paths)} potential Fusion 360 Python installation(s):")
@@ -181,25 +253,29 @@ def main():
     
     # Ask for confirmation to install for all instances
     print(f"\nThis will install MCP with CLI extras for ALL {len(python_paths)} Python installations.")
-    print("Using package specification: mcp[cli]")
-    confirm = input("Proceed with installation for all installations? (y/n): ")
-    
-    if confirm.lower() != 'y':
-        print("Installation cancelled.")
-        return
+    print("Using package specification: mcp[cli] uvicorn[standard] orjson")
+    if not args.yes:
+        confirm = input("Proceed with installation for all installations? (y/n): ")
+        
+        if confirm.lower() != 'y':
+            print("Installation cancelled.")
+            return 0
     
     # Install MCP for all found Python installations
     successful_installs = 0
     failed_installs = 0
     
-    for python_path in python_paths:
-        success = install_mcp(python_path)
-        if success:
-            successful_installs += 1
-            print(f"\n✓ Successfully installed MCP for: {python_path}")
-        else:
-            failed_installs += 1
-            print(f"\n✗ Failed to install MCP for: {python_path}")
+    # Each installation has its own site-packages, so they can run in parallel
+    with ThreadPoolExecutor(max_workers=min(4, len(python_paths))) as executor:
+        futures = {executor.submit(install_mcp, python_path, args.upgrade): python_path for python_path in python_paths}
+        for future in as_completed(futures):
+            python_path = futures[future]
+            if future.result():
+                successful_installs += 1
+                print(f"\n✓ Successfully installed MCP for: {python_path}")
+            else:
+                failed_installs += 1
+                print(f"\n✗ Failed to install MCP for: {python_path}")
     
     # Final summary
     print("\n=== Installation Summary ===")
@@ -213,9 +289,12 @@ def main():
     if failed_installs > 0:
         print("\nFor failed installations, you may need to try manually:")
         print("  1. Run this script as administrator")
-        print("  2. Or install manually with: '[Python Path]' -m pip install \"mcp[cli]\"")
+        print("  2. Or install manually with: '[Python Path]' -m pip install \"mcp[cli]\" \"uvicorn[standard]\" orjson")
+    
+    if not args.yes:
+        input("\nPress Enter to exit...")
     
-    input("\nPress Enter to exit...")
+    return 1 if failed_installs > 0 else 0
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    sys.exit(main()) 
\ No newline at end of file